@@ -12,15 +12,56 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 import pickle
+import warnings
 
+from numpy.lib.stride_tricks import sliding_window_view
 from sklearn.preprocessing import MinMaxScaler, RobustScaler, StandardScaler
 
+from collections import OrderedDict
+
+from ..utils.preprocessing import expand_windows, window_offsets, anchors_from_windows, load_dataset
+
 #############################
 #         Classes
 #############################
+class SetCache:
+    # least recently used cache of gathered set tensors within a memory budget in bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes   = 0
+        self.items     = OrderedDict()
+        
+    def get(self, key):
+        if key not in self.items:
+            return None
+        self.items.move_to_end(key)
+        return self.items[key]
+    
+    def put(self, key, arrays):
+        size = sum(a.nbytes for a in arrays)
+        if size > self.max_bytes:
+            return
+        if key in self.items:
+            self.n_bytes -= sum(a.nbytes for a in self.items.pop(key))
+        while self.n_bytes + size > self.max_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.n_bytes -= sum(a.nbytes for a in evicted)
+        for a in arrays:
+            # cached tensors are shared between calls
+            a.setflags(write=False)
+        self.items[key] = arrays
+        self.n_bytes += size
+    
+    def clear(self):
+        self.items.clear()
+        self.n_bytes = 0
+
 class DataModelCV:
-    def __init__(self, csv_path, target_name, hincast_features, forecast_features):
+    def __init__(self, csv_path, target_name, hincast_features, forecast_features, use_cache=True, cache_bytes=2**30):
         self.csv_path = csv_path 
+        self.use_cache = use_cache
+        # cache of gathered sets across folds, set cache_bytes to 0 to disable
+        self.set_cache = SetCache(cache_bytes)
         self.target            = [target_name]
         self.hincast_features  = hincast_features
         self.forecast_features = forecast_features
@@ -30,109 +71,213 @@ class DataModelCV:
             }
         
         self.df = None
+        self.matrices = {}
+        self.scaled_matrices = {}
         
     def loadCSV(self):
-        self.df = pd.read_csv(self.csv_path, parse_dates=['time'], index_col='time')
-        if self.df.index.tz == None:
-            # make TZ aware
-            print("datetimes set to UTC+0000")
-            self.df.index = self.df.index.tz_localize("Europe/London", ambiguous='raise').tz_convert("UTC")
-        else:
-            self.df.index = self.df.index.tz_convert("UTC")
+        # binary cache of the csv, rebuilt whenever the csv changes
+        self.df = load_dataset(self.csv_path, utc=True, use_cache=self.use_cache)
+        self.buildFeatureMatrices()
+    
+    def buildFeatureMatrices(self):
+        # one contiguous float32 matrix per input, windows are strided views into them
+        features = {"hincast" : self.hincast_features,
+                    "forecast": self.forecast_features,
+                    "target"  : self.target,
+                    }
+        self.matrices = {key: np.ascontiguousarray(self.df[feat].values, dtype=np.float32) for key, feat in features.items()}
+        self.scaled_matrices = {}
+        self.set_cache.clear()
+    
+    def scaleFeatureMatrices(self):
+        # MinMax scaling is per column, so the inputs are scaled once on the 
+        # feature matrices and scaled windows are gathered from them directly
+        self.set_cache.clear()
+        self.scaled_matrices = {"hincast" : self.scaler_hincast.transform(self.matrices["hincast"]),
+                                "forecast": self.scaler_forecast.transform(self.matrices["forecast"]),
+                                }
 
     
-    def loadCrossIndices(self, filename='cross_indices.json'):
+    def loadCrossIndices(self, filename='cross_indices.json', hincast_len=None):
         # Read dictionary pkl file
         with open(filename, 'rb') as fp:
             dic = pickle.load(fp)
         print('dictonary loaded')
-        self.sets   = dic["sets"]
         self.params.update(dic["params"])
+        self.set_cache.clear()
         
-    def getDataSet(self, n_set, scale=False, shuffle=False, box_cox=False):
-        if type(n_set) == type(list()):
-            hi, fi, yi = [], [], []
-            for n in n_set:
-                hn, fn, yn = self.sets[n]
-                hi.append(hn)
-                fi.append(fn)
-                yi.append(yn)
-            hi = np.concatenate(hi, axis=0)
-            fi = np.concatenate(fi, axis=0)
-            yi = np.concatenate(yi, axis=0)
+        self.valid_rows = {}
+        if dic["params"].get("index_format", "dense") == "anchor":
+            self.sets = dic["sets"]
         else:
-            hi, fi, yi = self.sets[n_set]
+            self.sets = self.convertDenseIndices(dic["sets"])
         
-        sorting = np.arange(yi.shape[0])
+        if "hincast_lengths" in dic["params"]:
+            # shared file of all hincast lengths, stored at the longest one
+            if hincast_len is None:
+                hincast_len = dic["params"]["hincast_len"]
+            if hincast_len > dic["params"]["hincast_len"]:
+                raise ValueError(f"hincast_len {hincast_len} exceeds the stored hincast length {dic['params']['hincast_len']}")
+            self.params["hincast_len"] = hincast_len
+        elif hincast_len is not None and hincast_len != dic["params"]["hincast_len"]:
+            raise ValueError(f"file {filename} holds hincast length {dic['params']['hincast_len']}, not {hincast_len}")
+        self.params["index_format"] = "anchor"
+    
+    def convertDenseIndices(self, dense_sets):
+        # compatibility with index files holding dense (hincast, forecast, target) arrays,
+        # rows that are no valid windows are dropped and marked in self.valid_rows
+        sets = {}
+        for key, (hi, fi, yi) in dense_sets.items():
+            sets[key], self.valid_rows[key] = anchors_from_windows(hi, fi, yi)
+            if np.any(~self.valid_rows[key]):
+                warnings.warn(f"set {key}: {np.sum(~self.valid_rows[key])} of {hi.shape[0]} rows of the dense index file are no valid windows and were removed, "
+                              f"predictions saved with this file are no longer aligned with the targets and times of the set, filter them with getValidRows({key})")
+        return sets
+    
+    def getValidRows(self, n_set):
+        # mask of the rows of a legacy dense index file that are kept, cached 
+        # predictions of these files are aligned again with predictions[mask]
+        n_sets = n_set if type(n_set) == type(list()) else [n_set]
+        return np.concatenate([self.valid_rows.get(n, np.ones(self.sets[n].shape[0], dtype=bool)) for n in n_sets], axis=0)
+    
+    def getAnchors(self, n_set):
+        if type(n_set) == type(list()):
+            return np.concatenate([self.sets[n] for n in n_set], axis=0)
+        return self.sets[n_set]
+    
+    def getOffsets(self):
+        return window_offsets(self.params["hincast_len"])
+    
+    def getIndexArrays(self, n_set, anchors=None):
+        # dense (hincast, forecast, target) index arrays, expanded from the anchors
+        if anchors is None:
+            anchors = self.getAnchors(n_set)
+        lengths = (self.params["hincast_len"], self.params["forecast_len"], self.params["target_len"])
+        return tuple(expand_windows(anchors, first, length) for first, length in zip(self.getOffsets(), lengths))
+        
+    def getDataSet(self, n_set, scale=False, shuffle=False, box_cox=False, copy=True):
+        # copy=False returns the cached read-only arrays of a single unshuffled set
+        if scale is True or scale is False:
+            return self.getCachedDataSet(n_set, scale, shuffle, copy)
+        
+        anchors = self.getAnchors(n_set)
+        
+        sorting = np.arange(anchors.shape[0])
         if shuffle:
             np.random.shuffle(sorting)
+            anchors = anchors[sorting]
 
-        Xh = self.getWithIndexArray(self.hincast_features, hi[sorting,:,:])
-        Xf = self.getWithIndexArray(self.forecast_features, fi[sorting,:,:])
-        y  = self.getWithIndexArray(self.target, yi[sorting,:,:])
+        return self.getBatch(anchors, scale)
+    
+    def getCachedSet(self, n_set, scale=False):
+        key = (n_set, scale, self.params["hincast_len"])
+        arrays = self.set_cache.get(key)
+        if arrays is None:
+            (Xh, Xf), y = self.getBatch(self.sets[n_set], scale)
+            arrays = (Xh, Xf, y)
+            self.set_cache.put(key, arrays)
+        return arrays
+    
+    def getCachedDataSet(self, n_set, scale=False, shuffle=False, copy=True):
+        # sets are gathered once and kept in the set cache, a list of sets 
+        # (expanding training window) is assembled from the cached sets
+        n_sets = n_set if type(n_set) == type(list()) else [n_set]
+        pieces = [self.getCachedSet(n, scale) for n in n_sets]
+        
+        sizes   = [p[2].shape[0] for p in pieces]
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        
+        sorting = np.arange(offsets[-1])
+        if shuffle:
+            np.random.shuffle(sorting)
+        elif len(pieces) == 1:
+            Xh, Xf, y = [a.copy() for a in pieces[0]] if copy else pieces[0]
+            return ((Xh, Xf), y)
+        
+        # preallocated output, every sample is copied once from its cached set
+        out = [np.empty((offsets[-1],) + a.shape[1:], dtype=a.dtype) for a in pieces[0]]
+        if shuffle:
+            source = np.searchsorted(offsets, sorting, side="right") - 1
+            for n, piece in enumerate(pieces):
+                rows = np.flatnonzero(source == n)
+                for o, a in zip(out, piece):
+                    o[rows] = a[sorting[rows] - offsets[n]]
+        else:
+            for n, piece in enumerate(pieces):
+                for o, a in zip(out, piece):
+                    o[offsets[n]:offsets[n+1]] = a
+        
+        Xh, Xf, y = out
+        return ((Xh, Xf), y)
+    
+    def getBatch(self, anchors, scale=False):
+        lengths = (self.params["hincast_len"], self.params["forecast_len"], self.params["target_len"])
+        
+        if scale is True:
+            if not self.scaled_matrices:
+                self.scaleFeatureMatrices()
+            Xh, Xf, y = [self.getWindows(key, anchors, first, length, scaled=(key != "target")) 
+                         for key, first, length in zip(["hincast", "forecast", "target"], self.getOffsets(), lengths)]
+            return ((Xh, Xf), y)
+        
+        Xh, Xf, y = [self.getWindows(key, anchors, first, length) 
+                     for key, first, length in zip(["hincast", "forecast", "target"], self.getOffsets(), lengths)]
         
         dataset = ((Xh, Xf), y)
         
         if scale:
-            dataset = self.applyScaler(dataset, scale)
+            # only selected hincast steps are scaled, done per step on the gathered windows
+            # scaling is done in place, read-only views into the feature matrices are copied first
+            Xh = Xh if Xh.flags.writeable else Xh.copy()
+            Xf = Xf if Xf.flags.writeable else Xf.copy()
+            dataset = self.applyScaler(((Xh, Xf), y), scale)
         return dataset
     
+    def getTargets(self, n_set, anchors=None):
+        # observed target windows of a set in sample order, without gathering the inputs
+        if anchors is None:
+            anchors = self.getAnchors(n_set)
+        return self.getWindows("target", anchors, self.getOffsets()[2], self.params["target_len"])
+    
+    def getDataSequence(self, n_set, batch_size, scale=False, shuffle=False, seed=None):
+        # streaming alternative to getDataSet, batches are gathered on demand
+        from .sequences import DataSequence
+        return DataSequence(self, n_set, batch_size, scale=scale, shuffle=shuffle, seed=seed)
+    
+    def getWindows(self, key, anchors, first, length, scaled=False):
+        # (n_samples, length, n_features) windows starting at anchor + first,
+        # a read-only view if the windows are consecutive, else a single gather
+        matrix  = self.scaled_matrices[key] if scaled else self.matrices[key]
+        windows = sliding_window_view(matrix, length, axis=0).transpose(0,2,1)
+        starts  = anchors.astype(int) + first
+        if len(starts) > 0 and np.all(np.diff(starts) == 1):
+            return windows[starts[0]:starts[-1]+1]
+        return windows[starts]
+    
     def getTimeSet(self, n_set, depth=0):
-        if type(n_set) == type(list()):
-            hi, fi, yi = [], [], []
-            for n in n_set:
-                hn, fn, yn = self.sets[n]
-                hi.append(hn)
-                fi.append(fn)
-                yi.append(yn)
-            hi = np.concatenate(hi, axis=0)
-            fi = np.concatenate(fi, axis=0)
-            yi = np.concatenate(yi, axis=0)
-        else:
-            hi, fi, yi = self.sets[n_set]
+        anchors = self.getAnchors(n_set)
             
-        timeset = (self.df.index[hi[:,depth,0]], 
-                   self.df.index[fi[:,depth,0]], 
-                   self.df.index[yi[:,depth,0]],
-                   )
+        timeset = tuple(self.df.index[anchors + first + depth] for first in self.getOffsets())
         
         return timeset
     
     def getFeatureSet(self, n_set, feature_name, depth=0):
-        if type(n_set) == type(list()):
-            hi, fi, yi = [], [], []
-            for n in n_set:
-                hn, fn, yn = self.sets[n]
-                hi.append(hn)
-                fi.append(fn)
-                yi.append(yn)
-            hi = np.concatenate(hi, axis=0)
-            fi = np.concatenate(fi, axis=0)
-            yi = np.concatenate(yi, axis=0)
-        else:
-            hi, fi, yi = self.sets[n_set]
+        anchors = self.getAnchors(n_set)
         
-        featureset = (self.df[feature_name].iloc[hi[:,depth,0]], 
-                   self.df[feature_name].iloc[fi[:,depth,0]], 
-                   self.df[feature_name].iloc[yi[:,depth,0]],
-                   )
+        featureset = tuple(self.df[feature_name].iloc[anchors + first + depth] for first in self.getOffsets())
         
         return featureset
     
-    def getWithIndexArray(self, feat, idx):
-        array = []
-        for f in feat:
-            array.append(self.df[f].values[idx])
-            
-        return np.concatenate(array, axis=2)
-    
     def fitScaler(self, n_set):
-        X, y = self.getDataSet(n_set)
+        # fitted on the first step of every hincast/forecast window of n_set only
+        anchors = self.getAnchors(n_set)
+        first_hincast, first_forecast, _ = self.getOffsets()
         scaler_hincast  = MinMaxScaler()
         scaler_forecast = MinMaxScaler()
         
-        self.scaler_hincast  = scaler_hincast.fit(X[0][:,0,:])
-        self.scaler_forecast = scaler_forecast.fit(X[1][:,0,:])
+        self.scaler_hincast  = scaler_hincast.fit(self.matrices["hincast"][anchors + first_hincast])
+        self.scaler_forecast = scaler_forecast.fit(self.matrices["forecast"][anchors + first_forecast])
+        self.scaleFeatureMatrices()
         
     def applyScaler(self, dataset, hindcast_scale_index=True):  
         X, y = dataset
@@ -160,9 +305,9 @@ class DataModelCV:
                  }
         return cross_sets
         
-    def main(self, filename='cross_indices.pkl', fit_scaler = True, verbose = 1):
+    def main(self, filename='cross_indices.pkl', fit_scaler = True, verbose = 1, hincast_len=None):
         self.loadCSV()
-        self.loadCrossIndices(filename=filename)
+        self.loadCrossIndices(filename=filename, hincast_len=hincast_len)
         
         self.cross_sets = self.getCrossValidSets(self.params["n_sets"])
 
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Manuel Pirker
+"""
+
+#############################
+#         Imports
+#############################
+import tensorflow as tf
+import numpy as np
+
+#############################
+#         Functions
+#############################
+def epoch_orders(n_samples, shuffle=False, seed=None):
+    # sample order of every epoch, a new permutation from the seeded generator 
+    # per epoch with shuffle. Streamed and materialized sets use the same orders
+    rng = np.random.default_rng(seed)
+    while True:
+        yield rng.permutation(n_samples) if shuffle else np.arange(n_samples)
+
+def position_batches(n_samples, batch_size, shuffle=False, seed=None):
+    # tf.data pipeline of the sample positions of every batch, each iteration
+    # (epoch) takes the next order of epoch_orders
+    orders = epoch_orders(n_samples, shuffle, seed)
+    n_batches = int(np.ceil(n_samples / batch_size))
+    
+    def generate():
+        order = next(orders)
+        for start in range(0, n_samples, batch_size):
+            yield order[start:start+batch_size]
+    
+    dataset = tf.data.Dataset.from_generator(generate, output_signature=tf.TensorSpec((None,), tf.int64))
+    return dataset.apply(tf.data.experimental.assert_cardinality(n_batches))
+
+def batch_dataset(load_batch, n_samples, batch_size, shapes, shuffle=False, seed=None,
+                  num_parallel_calls=tf.data.AUTOTUNE, prefetch=tf.data.AUTOTUNE):
+    # batches of load_batch(positions) -> (Xh, Xf, y) gathered in parallel
+    def load(positions):
+        batch = tf.numpy_function(load_batch, [positions], [tf.float32]*3)
+        Xh, Xf, y = [tf.ensure_shape(x, shape) for x, shape in zip(batch, shapes)]
+        return (Xh, Xf), y
+    
+    dataset = position_batches(n_samples, batch_size, shuffle, seed)
+    dataset = dataset.map(load, num_parallel_calls=num_parallel_calls, deterministic=True)
+    return dataset.prefetch(prefetch)
+
+def array_dataset(X, y, batch_size, shuffle=False, seed=None):
+    # tf.data pipeline over materialized arrays ((Xh, Xf), y), batched in the
+    # same sample order as DataSequence.asDataset for the same seed
+    Xh, Xf = X
+    shapes = [(None,) + a.shape[1:] for a in (Xh, Xf, y)]
+    
+    def load_batch(positions):
+        return tuple(np.asarray(a[positions], dtype=np.float32) for a in (Xh, Xf, y))
+    
+    return batch_dataset(load_batch, y.shape[0], batch_size, shapes, shuffle, seed)
+
+#############################
+#         Classes
+#############################
+class DataSequence(tf.keras.utils.Sequence):
+    # Streams the samples of one or several sets of a DataModelCV batch by batch.
+    # The sample orders come from epoch_orders, so for the same seed the batches
+    # equal those of array_dataset over the materialized set, also without shuffle
+    def __init__(self, data_model, n_set, batch_size, scale=False, shuffle=False, seed=None):
+        self.data_model = data_model
+        self.batch_size = int(batch_size)
+        self.scale      = scale
+        self.shuffle    = shuffle
+        self.seed       = seed
+        
+        self.anchors = data_model.getAnchors(n_set)
+        self.orders  = epoch_orders(self.anchors.shape[0], shuffle, seed)
+        self.order   = next(self.orders)
+        
+    def __len__(self):
+        return int(np.ceil(self.anchors.shape[0] / self.batch_size))
+    
+    def __getitem__(self, idx):
+        return self.data_model.getBatch(self.anchors[self.order[idx*self.batch_size:(idx+1)*self.batch_size]], self.scale)
+    
+    def on_epoch_end(self):
+        # sample order of the next epoch when fitted as keras Sequence
+        self.order = next(self.orders)
+    
+    def getNumpySamples(self, positions):
+        # batch of the samples at the given positions of self.anchors
+        (Xh, Xf), y = self.data_model.getBatch(self.anchors[positions], self.scale)
+        return (np.asarray(Xh, dtype=np.float32), 
+                np.asarray(Xf, dtype=np.float32), 
+                np.asarray(y,  dtype=np.float32))
+    
+    def asDataset(self, num_parallel_calls=tf.data.AUTOTUNE, prefetch=tf.data.AUTOTUNE):
+        # tf.data pipeline gathering batches in parallel, every epoch takes 
+        # the next sample order of a new epoch_orders generator
+        params = self.data_model.params
+        shapes = ((None, params["hincast_len"],  params["n_features_hc"]),
+                  (None, params["forecast_len"], params["n_features_fc"]),
+                  (None, params["target_len"],   1),
+                  )
+        return batch_dataset(self.getNumpySamples, self.anchors.shape[0], self.batch_size, shapes, 
+                             self.shuffle, self.seed, num_parallel_calls, prefetch)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Manuel Pirker
+"""
+
+#############################
+#         Imports
+#############################
+import numpy as np
+
+#############################
+#         Functions
+#############################
+def sigmoid(x):
+    # overflow free logistic function
+    return 0.5 * (1 + np.tanh(0.5 * x))
+
+def lstm_weights(layer):
+    kernel, recurrent_kernel, bias = layer.get_weights()
+    return {"kernel": kernel, "recurrent_kernel": recurrent_kernel, "bias": bias}
+
+def get_hindcast_weights(model):
+    # weights of a trained Hindcast model, the layers are found by the
+    # graph so this works for built and loaded models
+    layers  = [layer for layer in model.layers if layer.__class__.__name__ == "LSTM"]
+    encoder = [layer for layer in layers if layer.return_state][0]
+    decoder = [layer for layer in layers if not layer.return_state][0]
+
+    # the decoder is called with [inputs, hidden state, cell state]
+    _, dense_hidden, dense_cell = [t._keras_history.layer for t in decoder.input]
+    dense_out = model.layers[-1]
+
+    weights = {}
+    for name, layer in [("encoder", encoder), ("decoder", decoder)]:
+        for key, value in lstm_weights(layer).items():
+            weights[f"{name}_{key}"] = value
+    for name, layer in [("hidden", dense_hidden), ("cell", dense_cell), ("output", dense_out)]:
+        weights[f"{name}_kernel"], weights[f"{name}_bias"] = layer.get_weights()
+    return weights
+
+def export_hindcast(model, path):
+    # writes the weights of a trained Hindcast model to a .npz file
+    weights = get_hindcast_weights(model)
+    np.savez(path, **weights)
+    return weights
+
+#############################
+#         Classes
+#############################
+class HindcastEngine:
+    # NumPy forward pass of the Hindcast LSTM, reproduces model.predict
+    def __init__(self, weights, dtype=np.float32):
+        self.dtype   = dtype
+        self.weights = {key: np.asarray(value, dtype=dtype) for key, value in weights.items()}
+
+        self.units         = self.weights["encoder_recurrent_kernel"].shape[0]
+        self.n_features_hc = self.weights["encoder_kernel"].shape[0]
+        self.n_features_fc = self.weights["decoder_kernel"].shape[0]
+        self.target_len    = self.weights["output_bias"].shape[0]
+        self.forecast_len  = self.weights["output_kernel"].shape[0] // self.units
+
+    @classmethod
+    def from_npz(cls, path, dtype=np.float32):
+        with np.load(path) as data:
+            return cls(dict(data), dtype)
+
+    @classmethod
+    def from_model(cls, model, dtype=np.float32):
+        return cls(get_hindcast_weights(model), dtype)
+
+    def lstm(self, x, name, h, c, return_sequences=False):
+        # keras gate order i, f, c, o with sigmoid recurrent activation
+        W, U, b = [self.weights[f"{name}_{key}"] for key in ["kernel", "recurrent_kernel", "bias"]]
+        u = self.units
+
+        # input projection of all time steps at once
+        z_x = x @ W + b
+
+        if return_sequences:
+            out = np.empty((x.shape[0], x.shape[1], u), dtype=self.dtype)
+        for t in range(x.shape[1]):
+            z = z_x[:, t] + h @ U
+            i = sigmoid(z[:, :u])
+            f = sigmoid(z[:, u:2*u])
+            c = f * c + i * np.tanh(z[:, 2*u:3*u])
+            h = sigmoid(z[:, 3*u:]) * np.tanh(c)
+            if return_sequences:
+                out[:, t] = h
+
+        if return_sequences:
+            return out, h, c
+        return h, c
+
+    def encode(self, x_hincast):
+        # initial decoder states from the hindcast window
+        zeros = np.zeros((x_hincast.shape[0], self.units), dtype=self.dtype)
+        h, c  = self.lstm(np.asarray(x_hincast, dtype=self.dtype), "encoder", zeros, zeros)
+
+        h = h @ self.weights["hidden_kernel"] + self.weights["hidden_bias"]
+        c = c @ self.weights["cell_kernel"]   + self.weights["cell_bias"]
+        return h, c
+
+    def decode(self, x_forecast, h, c):
+        out, _, _ = self.lstm(np.asarray(x_forecast, dtype=self.dtype), "decoder", h, c, return_sequences=True)
+
+        # flatten, dropout is inactive at inference, relu output layer
+        out = out.reshape(out.shape[0], -1) @ self.weights["output_kernel"] + self.weights["output_bias"]
+        return np.maximum(out, 0)
+
+    def predict(self, x, batch_size=None):
+        # x = [hincast, forecast] as for the keras model
+        x_hincast, x_forecast = x
+        n = x_hincast.shape[0]
+        batch_size = n if batch_size is None else batch_size
+
+        y = np.empty((n, self.target_len), dtype=self.dtype)
+        for i in range(0, n, batch_size):
+            h, c = self.encode(x_hincast[i:i+batch_size])
+            y[i:i+batch_size] = self.decode(x_forecast[i:i+batch_size], h, c)
+        return y
+
+class OnlineForecaster:
+    # forecasts one time step after the other for a batch of gauges, the 
+    # scaled inputs are kept in ring buffers so no windows are rebuilt
+    def __init__(self, engine, scaler_hincast, scaler_forecast, hincast_len, n_gauges=1):
+        self.engine       = engine
+        self.hincast_len  = hincast_len
+        self.forecast_len = engine.forecast_len
+        self.n_gauges     = n_gauges
+        
+        # MinMaxScaler parameters, applied like scaler.transform
+        self.scalers = {"hincast" : (scaler_hincast.scale_,  scaler_hincast.min_),
+                        "forecast": (scaler_forecast.scale_, scaler_forecast.min_),
+                        }
+        
+        # every row is written twice, so the window ending at the latest row
+        # is always the contiguous slice buffer[:, pos:pos+length]
+        self.lengths = {"hincast": hincast_len, "forecast": self.forecast_len}
+        self.buffers = {"hincast" : np.zeros((n_gauges, 2*hincast_len, engine.n_features_hc), dtype=engine.dtype),
+                        "forecast": np.zeros((n_gauges, 2*self.forecast_len, engine.n_features_fc), dtype=engine.dtype),
+                        }
+        self.pos   = {"hincast": 0, "forecast": 0}
+        self.n_obs = 0
+        self.has_forecast = False
+        
+        # time step of the latest row of each buffer, the forcing window is
+        # only aligned with the observations if both are at the same step
+        self.steps = {"hincast": 0, "forecast": 0}
+        
+    def scale(self, key, x):
+        scale, offset = self.scalers[key]
+        x = np.array(x, dtype=self.engine.dtype)
+        x *= scale
+        x += offset
+        return x
+        
+    def push(self, key, rows):
+        # appends one scaled row per gauge to the ring buffer
+        length = self.lengths[key]
+        pos    = self.pos[key]
+        self.buffers[key][:, pos]        = rows
+        self.buffers[key][:, pos+length] = rows
+        self.pos[key] = (pos + 1) % length
+        
+    def fill(self, key, window):
+        length = self.lengths[key]
+        self.buffers[key][:, :length] = window
+        self.buffers[key][:, length:] = window
+        self.pos[key] = 0
+        
+    def initialize(self, hincast, forecast):
+        # unscaled windows (n_gauges, hincast_len, n_features_hc) and (n_gauges, forecast_len, n_features_fc)
+        self.fill("hincast", self.scale("hincast", hincast))
+        self.n_obs = self.hincast_len
+        self.set_forecast(forecast)
+        
+    def set_forecast(self, forecast):
+        # replaces the forcing window, e.g. when a new weather forecast arrives
+        self.fill("forecast", self.scale("forecast", forecast))
+        self.has_forecast = True
+        self.steps["forecast"] = self.steps["hincast"]
+        
+    def update(self, hincast_row, forecast_row=None):
+        # observation rows (n_gauges, n_features_hc) of the new time step and 
+        # optionally the forcing rows (n_gauges, n_features_fc) at the end of the horizon
+        self.push("hincast", self.scale("hincast", hincast_row))
+        self.n_obs += 1
+        self.steps["hincast"] += 1
+        if forecast_row is not None:
+            self.push("forecast", self.scale("forecast", forecast_row))
+            self.steps["forecast"] += 1
+        
+    def windows(self):
+        # scaled model inputs of the current time step
+        if self.n_obs < self.hincast_len or not self.has_forecast:
+            raise ValueError(f"online forecaster needs {self.hincast_len} observations and a forcing window")
+        if self.steps["forecast"] != self.steps["hincast"]:
+            raise ValueError(f"forcing window is at step {self.steps['forecast']} but the observations at step {self.steps['hincast']}, "
+                             "push a forcing row with every update or call set_forecast")
+        return [self.buffers[key][:, self.pos[key]:self.pos[key]+self.lengths[key]] for key in ["hincast", "forecast"]]
+        
+    def forecast(self):
+        return self.engine.predict(self.windows())
+        
+    def step(self, hincast_row, forecast_row=None):
+        self.update(hincast_row, forecast_row)
+        return self.forecast()
@@ -86,4 +86,33 @@ class Hindcast:
         model = tf.keras.Model(inputs=[inp_hincast, inp_forecast], outputs=hidden)
 
         #model.summary()
-        return model
\ No newline at end of file
+        return model
+
+#%% compiled inference
+class CompiledPredictor:
+    # XLA compiled predict with one fixed input shape, the last batch is padded
+    # so the function is traced and compiled only once
+    def __init__(self, model, batch_size):
+        self.model      = model
+        self.batch_size = batch_size
+        
+        input_signature = [[tf.TensorSpec((batch_size,) + tuple(inp.shape[1:]), inp.dtype) for inp in model.inputs]]
+        self.predict_fn = tf.function(lambda x: model(x, training=False),
+                                      input_signature = input_signature,
+                                      jit_compile     = True)
+        
+    def predict_batch(self, x):
+        n   = x[0].shape[0]
+        pad = self.batch_size - n
+        if pad > 0:
+            x = [np.concatenate([xi, np.zeros((pad,) + xi.shape[1:], dtype=xi.dtype)]) for xi in x]
+        return self.predict_fn(x).numpy()[:n]
+        
+    def predict(self, x):
+        # x = [hincast, forecast] arrays or a dataset of ([hincast, forecast], y) batches
+        if isinstance(x, tf.data.Dataset):
+            return np.concatenate([self.predict_batch([xi.numpy() for xi in batch[0]]) for batch in x])
+        
+        x = [np.asarray(xi, dtype=np.float32) for xi in x]
+        return np.concatenate([self.predict_batch([xi[i:i+self.batch_size] for xi in x]) 
+                               for i in range(0, x[0].shape[0], self.batch_size)])
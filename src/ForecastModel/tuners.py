@@ -17,38 +17,316 @@ import keras_tuner
 from tensorboard.plugins.hparams import api as tb_hp
 
 from datetime import datetime
-import matplotlib.pyplot as plt
 
-import json
+import copy
+import multiprocessing
+from time import perf_counter
+from contextlib import contextmanager
 
-from ForecastModel.utils.metrics import evaluate_multistep, calculate_bias, calculate_kge, calculate_nse, calculate_rms, calculate_kge5alpha
+from ForecastModel.models import CompiledPredictor
+from ForecastModel.data.sequences import array_dataset
+from ForecastModel.utils.artifacts import ArtifactWriter, plot_fold, save_json, write_scalars
+from ForecastModel.utils.metrics import evaluate_multistep_batched, calculate_bias, calculate_kge, calculate_nse, calculate_rms, calculate_kge5alpha
+
+#############################
+#         Functions
+# ############################
+@contextmanager
+def stage_timer(timing, key):
+    # adds the wall time of the block to timing[key]
+    t0 = perf_counter()
+    try:
+        yield
+    finally:
+        timing[key] = timing.get(key, 0.0) + perf_counter() - t0
+
+def get_fold_data(data_model, n_set, batch_size, shuffle=False, streaming=False, targets=True, seed=None):
+    # materialized (X, y) arrays, or with streaming a tf.data pipeline that
+    # gathers and scales the batches on the fly plus the observed targets, 
+    # which are only gathered for evaluation (targets=True). Shuffled arrays are 
+    # batched by a tf.data pipeline too, in the streamed sample orders of the seed
+    if streaming:
+        sequence = data_model.getDataSequence(n_set, batch_size, scale=True, shuffle=shuffle, seed=seed)
+        return sequence.asDataset(), data_model.getTargets(n_set, sequence.anchors) if targets else None
+    # the arrays are only read, so cached sets are used without a copy
+    X, y = data_model.getDataSet(n_set, scale=True, copy=False)
+    if shuffle:
+        return array_dataset(X, y, batch_size, shuffle, seed), y if targets else None
+    return X, y
+
+def run_fold(hypermodel, hp, trial_id, data_model, num, cross_set, epochs, callbacks, metric_fcns, tb_log_path, current_log_path, 
+             shuffle=False, plot_fold_rst=True, save_fold_models=False, save_fold_prediction=True, streaming=False, seed=None,
+             initial_weights=None, warm_epochs=5, warm_lr_factor=0.5, tag="", artifacts=None, return_fit_weights=False):
+    # trains and evaluates a single cross validation fold, returns the fold metrics and the model
+    # with initial_weights the model continues from the previous fold (walk forward),
+    # return_fit_weights also returns the weights before the retrain on the validation set
+    own_artifacts = artifacts is None
+    if own_artifacts:
+        artifacts = ArtifactWriter()
+    
+    # logging
+    TensorBoardCallback = tf.keras.callbacks.TensorBoard(
+        os.path.join(current_log_path, f"fold_{num:02d}"), 
+        write_graph  = False,
+        write_images = False,
+        histogram_freq=None)
+
+
+    print(f"processing cross_set {cross_set} -------------------------------")
+    fold_metrics = {"valid": {}, "test": {}}
+    timing = {}
+    train_sets = data_model.cross_sets[cross_set]["train"] if initial_weights is None else data_model.cross_sets[cross_set]["train"][-1:]
+    with stage_timer(timing, "get_data"):
+        X_train, y_train = get_fold_data(data_model, train_sets, hp["batch_size"], shuffle, streaming, targets=False, seed=seed)
+        X_valid, y_valid = get_fold_data(data_model, data_model.cross_sets[cross_set]["valid"], hp["batch_size"], False, streaming)
+    
+    # build model
+    K.clear_session()
+    model = hypermodel.build(hp)
+    
+    # fixed shape predict if the hypermodel is compiled with jit_compile=True
+    predictor = None
+    if model.jit_compile:
+        predictor = CompiledPredictor(model, hp["batch_size"])
+    
+    if initial_weights is None:
+        # training on training set
+        print("train model")
+        # reset learning rate to inital value
+        K.set_value(model.optimizer.learning_rate, hp["lr"])
+    else:
+        # fine-tuning on the newly added set only
+        print("fine-tune model of previous fold")
+        model.set_weights(initial_weights)
+        K.set_value(model.optimizer.learning_rate, hp["lr"]*warm_lr_factor)
+        epochs = warm_epochs
+    
+    # throughput is logged before the tensorboard callback writes the epoch logs
+    throughput = ThroughputCallback(data_model.getAnchors(train_sets).shape[0])
+    # shuffled and streamed training sets are batched pipelines, arrays are not shuffled again by fit
+    batched = streaming or shuffle
+    with stage_timer(timing, "fit"):
+        model.fit(X_train, None if batched else y_train, 
+                    epochs     = epochs, 
+                    batch_size = None if batched else hp["batch_size"], 
+                    shuffle    = False,
+                    validation_data = X_valid if streaming else (X_valid, y_valid), 
+                    callbacks = callbacks + [throughput, TensorBoardCallback], 
+                    verbose = 1,)
+    timing["samples_per_sec"] = throughput.samples_per_sec
+    timing["step_time"]       = throughput.step_time
+    
+    if return_fit_weights:
+        fit_weights = model.get_weights()
+    
+    # eval on validation set
+    with stage_timer(timing, "predict"):
+        if predictor is None:
+            y_pred_valid = model.predict(X_valid,
+                                        batch_size = None if streaming else hp["batch_size"])
+        else:
+            y_pred_valid = predictor.predict(X_valid)
+    
+    with stage_timer(timing, "metrics"):
+        fold_metrics["valid"] = evaluate_multistep_batched(y_valid, y_pred_valid, metric_fcns)
+        
+    del y_pred_valid, X_train, y_train
+       
+    # load new data
+    with stage_timer(timing, "get_data"):
+        X_train_valid, y_train_valid = get_fold_data(data_model, data_model.cross_sets[cross_set]["train_valid"][-1:], hp["batch_size"], shuffle, streaming, targets=False, seed=seed) 
+    
+    print("retrain model with new data")
+    # reset learning rate to half of initial value
+    K.set_value(model.optimizer.learning_rate, hp["lr"]/2)
+    
+    # continue training with validation set   
+    with stage_timer(timing, "retrain"):
+        model.fit(X_train_valid, None if batched else y_train_valid, 
+                  epochs     = hp["retrain_epochs"], 
+                  batch_size = None if batched else hp["batch_size"],
+                  shuffle    = False,
+                  callbacks = TensorBoardCallback,
+                  verbose    = 1)
+    
+    del X_train_valid, y_train_valid
+    
+    # evaluate on testing set
+    print("evaluate model performence")
+    
+    # load new data
+    with stage_timer(timing, "get_data"):
+        X_test,  y_test  = get_fold_data(data_model, data_model.cross_sets[cross_set]["test"], hp["batch_size"], False, streaming) 
+    
+    with stage_timer(timing, "predict"):
+        if predictor is None:
+            y_pred_test = model.predict(X_test, 
+                                        batch_size = None if streaming else hp["batch_size"])
+        else:
+            y_pred_test = predictor.predict(X_test)
+
+    with stage_timer(timing, "metrics"):
+        fold_metrics["test"] = evaluate_multistep_batched(y_test, y_pred_test, metric_fcns)
+    
+    # saving traces the model functions, which is not thread safe while the next
+    # fold is built, so models are saved here and the other artifacts are written
+    # in the background, only a full queue blocks
+    with stage_timer(timing, "artifacts"):
+        if save_fold_models:
+            model.save(os.path.join(tb_log_path, "hp", f"trial_{trial_id}", f"model_fold_{num}.keras"))
+    
+        if save_fold_prediction:
+            artifacts.submit(np.save, os.path.join(current_log_path, f"pred_fold_{num}.npy"), y_pred_test)
+        
+        if plot_fold_rst:
+            artifacts.submit(plot_fold, os.path.join(tb_log_path, "logs", "trial_"+f"{trial_id}"), num, y_test, y_pred_test)
+        
+        # write for tensorboard
+        artifacts.submit(write_scalars, artifacts.summary_writer(current_log_path), 
+                         {f'{key}_fold_{num}{tag}': np.mean(fold_metrics["test"][key]) for key in ["kge", "nse"]})
+        
+        if own_artifacts:
+            artifacts.close()
+    
+    # delete variables
+    del X_test, y_test, y_pred_test
+    
+    fold_metrics["timing"] = timing
+    if return_fit_weights:
+        return fold_metrics, model, fit_weights
+    return fold_metrics, model
+
+def run_folds_walk_forward(fold_args, warm_epochs=5, warm_lr_factor=0.5, artifacts=None):
+    # runs the folds in order, each one starts from the weights of the previous 
+    # fold before its retrain on the validation set. That set is the newest 
+    # training set of the next fold, which is fine-tuned on it in the warm phase
+    weights = None
+    for args in fold_args:
+        fold_metrics, model, weights = run_fold(*args, initial_weights=weights, warm_epochs=warm_epochs, warm_lr_factor=warm_lr_factor, 
+                                                tag="_walk_forward", artifacts=artifacts, return_fit_weights=True)
+        yield fold_metrics, model
+
+def run_fold_process(threads, args):
+    # entry point of a fold worker process, CPU only with its own thread limits
+    tf.config.set_visible_devices([], "GPU")
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    
+    fold_metrics, model = run_fold(*args)
+    return fold_metrics, model.get_weights()
 
 #############################
 #         Classes
 # ############################
 # %
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    # training samples per second and time per step of every epoch, 
+    # validation is not included
+    def __init__(self, n_samples):
+        super().__init__()
+        self.n_samples       = n_samples
+        self.samples_per_sec = []
+        self.step_time       = []
+        
+    def on_epoch_begin(self, epoch, logs=None):
+        self.t_begin = perf_counter()
+        self.t_end   = self.t_begin
+        self.n_steps = 0
+        
+    def on_train_batch_end(self, batch, logs=None):
+        self.t_end    = perf_counter()
+        self.n_steps += 1
+        
+    def on_epoch_end(self, epoch, logs=None):
+        # no throughput of an epoch without training batches
+        if self.n_steps == 0:
+            return
+        t_train = self.t_end - self.t_begin
+        self.samples_per_sec.append(self.n_samples / t_train)
+        self.step_time.append(t_train / self.n_steps)
+        if logs is not None:
+            logs["samples_per_sec"] = self.samples_per_sec[-1]
+            logs["step_time"]       = self.step_time[-1]
+        
 class MyTuner(keras_tuner.BayesianOptimization):
     def on_trial_end(self, trial):
         super().on_trial_end(trial)
-        with tf.summary.create_file_writer(os.path.join(self.tb_log_path, r"logs\trial_"+f"{trial.trial_id}")).as_default():
+        # the score is set by the oracle, which runs on the chief in a distributed search
+        trial = self.oracle.get_trial(trial.trial_id)
+        with tf.summary.create_file_writer(self.get_log_path(trial.trial_id)).as_default():
             score = trial.score
             hparams = trial.hyperparameters.get_config()['values']
             tf.summary.scalar('score', score, step=1)
             tb_hp.hparams(hparams)
         
+    def get_log_path(self, trial_id):
+        # tensorboard logs of a trial, the workers of a distributed search 
+        # write to their own subdirectory of the shared tb_log_path
+        log_path = os.path.join(self.tb_log_path, self.tuner_id) if self._is_worker() else self.tb_log_path
+        return os.path.join(log_path, r"logs\trial_"+f"{trial_id}")
+        
     def save_model(self, trial, model):
         model.save(os.path.join(self.tb_log_path, "hp", f"trial_{trial.trial_id}", "model.keras"))
         
-    def save_model_fold(self, trial, fold_id, model):
-        model.save(os.path.join(self.tb_log_path, "hp", f"trial_{trial.trial_id}", f"model_fold_{fold_id}.keras"))
+    def run_folds_parallel(self, hp, fold_args, n_fold_workers, threads_per_worker=None):
+        # runs the folds in spawned CPU worker processes and yields the results
+        # in fold order, each with a model rebuilt from the fold weights
+        if threads_per_worker is None:
+            threads_per_worker = max(1, os.cpu_count() // n_fold_workers)
+        
+        # the workers get the data model without the gathered sets
+        data_model = copy.copy(fold_args[0][3])
+        data_model.set_cache = type(data_model.set_cache)(data_model.set_cache.max_bytes)
+        fold_args = [args[:3] + (data_model,) + args[4:] for args in fold_args]
+        
+        pool = multiprocessing.get_context("spawn").Pool(n_fold_workers)
+        try:
+            results = [pool.apply_async(run_fold_process, (threads_per_worker, args)) for args in fold_args]
+            for result in results:
+                fold_metrics, weights = result.get()
+                K.clear_session()
+                model = self.hypermodel.build(hp)
+                model.set_weights(weights)
+                yield fold_metrics, model
+        finally:
+            # when the trial is pruned the workers are killed, so running folds 
+            # are stopped and folds not started yet are dropped
+            pool.terminate()
+            pool.join()
+        
+    def should_prune(self, trial, num, fold_objective, prune_percentile=50, prune_min_trials=5):
+        # compares the running objective after fold num with the completed 
+        # trials at the same fold, median rule for prune_percentile=50
+        key = f"fold_objective_{num}"
+        values = [t.metrics.get_last_value(key) for t in self.completed_trials(trial) if t.metrics.exists(key)]
+        
+        if len(values) < prune_min_trials:
+            return False
+        return fold_objective > np.percentile(values, prune_percentile)
         
-    def run_trial(self, trial, data_model, verbose, epochs, callbacks, cross_indices_path, tb_log_path, shuffle=False, plot_fold_rst=True, save_fold_models=False, save_fold_prediction=True):
+    def completed_trials(self, trial):
+        # other completed trials that ran all folds, pruned trials are left out
+        return [t for t in self.oracle.get_best_trials(self.oracle.max_trials)
+                if t.trial_id != trial.trial_id and t.status == "COMPLETED" and not t.metrics.exists("pruned")]
+        
+    def pruned_score(self, trial, fold_objective):
+        # pessimistic score of a pruned trial, its running objective covers the 
+        # first folds only, so it never ranks above a trial that ran all folds
+        return max([fold_objective] + [t.score for t in self.completed_trials(trial)])
+        
+    def run_trial(self, trial, data_model, verbose, epochs, callbacks, cross_indices_path, tb_log_path, shuffle=False, plot_fold_rst=True, save_fold_models=False, save_fold_prediction=True, streaming=False, n_fold_workers=1, threads_per_worker=None, 
+                  prune_percentile=None, prune_min_trials=5, prune_min_folds=1, walk_forward=False, warm_epochs=5, warm_lr_factor=0.5,
+                  shared_indices=False, seed=None):
         print(trial.trial_id)
         
         # set tb_log_path
         self.tb_log_path = tb_log_path
         
-        current_log_path = os.path.join(tb_log_path, r"logs\trial_"+f"{trial.trial_id}")
+        current_log_path = self.get_log_path(trial.trial_id)
+        
+        # trial folders, with a distributed search the oracle only creates them on the chief
+        os.makedirs(current_log_path, exist_ok=True)
+        os.makedirs(os.path.join(tb_log_path, "hp", f"trial_{trial.trial_id}"), exist_ok=True)
         
         # load hyperparameters
         hp = trial.hyperparameters
@@ -56,7 +334,13 @@ class MyTuner(keras_tuner.BayesianOptimization):
         # get data model
         print(hp)
         hindcast_length = hp["hindcast_length"]
-        data_model.main(os.path.join(cross_indices_path, f"cross_indices_{hindcast_length}.pkl"), verbose)
+        timing = {}
+        with stage_timer(timing, "data_load"):
+            if shared_indices:
+                # splits of the longest hincast length, fewer samples than the per length files
+                data_model.main(os.path.join(cross_indices_path, "cross_indices_shared.pkl"), verbose, hincast_len=hindcast_length)
+            else:
+                data_model.main(os.path.join(cross_indices_path, f"cross_indices_{hindcast_length}.pkl"), verbose)
         
         metric_fcns = {"nse": calculate_nse,
                       "kge":  calculate_kge,
@@ -74,185 +358,98 @@ class MyTuner(keras_tuner.BayesianOptimization):
         for key in metric_fcns.keys():
             for on_set in metrics.keys():
                 metrics[on_set][key] = []
+        
+        # wall time of the trial stages, per fold lists for the fold stages
+        metrics["timing"] = timing
 
         total_num_of_folds = len(data_model.cross_sets.keys())
-        for num, cross_set in enumerate(data_model.cross_sets.keys()):
-            # logging
-            TensorBoardCallback = tf.keras.callbacks.TensorBoard(
-                os.path.join(current_log_path, f"fold_{num:02d}"), 
-                write_graph  = False,
-                write_images = False,
-                histogram_freq=None)
-    
-
-            print(f"processing cross_set {cross_set} -------------------------------")
-            X_train, y_train = data_model.getDataSet(data_model.cross_sets[cross_set]["train"], scale=True, shuffle=shuffle)
-            X_valid, y_valid = data_model.getDataSet(data_model.cross_sets[cross_set]["valid"], scale=True)
-            
-            # get simulation and measured values 
-            _, _, yidx = data_model.sets[data_model.cross_sets[cross_set]["valid"]]
-
-            # build model
-            K.clear_session()
-            model = self.hypermodel.build(hp)
-            
-            # training on training set
-            print("train model")
-            # reset learning rate to inital value
-            K.set_value(model.optimizer.learning_rate, hp["lr"])
-            model.fit(X_train, y_train, 
-                        epochs     = epochs, 
-                        batch_size = hp["batch_size"], 
-                        validation_data = (X_valid, y_valid), 
-                        callbacks = callbacks + [TensorBoardCallback], 
-                        verbose = 1,
-                        workers = 4,
-                        use_multiprocessing=True,)
+        fold_args = [(self.hypermodel, hp, trial.trial_id, data_model, num, cross_set, epochs, callbacks, metric_fcns, tb_log_path, current_log_path, 
+                      shuffle, plot_fold_rst, save_fold_models, save_fold_prediction, streaming, seed) for num, cross_set in enumerate(data_model.cross_sets.keys())]
+        
+        # plots, predictions and summaries of the trial, closed even if a fold fails
+        artifacts = ArtifactWriter()
+        try:
+            # folds are independent, run them one after another or in worker processes,
+            # with walk forward the folds depend on each other and always run in order
+            if walk_forward:
+                fold_results = run_folds_walk_forward(fold_args, warm_epochs, warm_lr_factor, artifacts)
+            elif n_fold_workers > 1:
+                fold_results = self.run_folds_parallel(hp, fold_args, n_fold_workers, threads_per_worker)
+            else:
+                fold_results = (run_fold(*args, artifacts=artifacts) for args in fold_args)
             
-            # eval on validation set
-            y_pred_valid = model.predict(X_valid,
-                                        batch_size = hp["batch_size"], 
-                                        workers = 4,
-                                        use_multiprocessing=True)
+            fold_objectives = {}
+            pruned = False
+            for num, (fold_metrics, model) in enumerate(fold_results):
+                for on_set in ["valid", "test"]:
+                    for key in metric_fcns.keys():
+                        metrics[on_set][key].append(fold_metrics[on_set][key])
+                for key, value in fold_metrics["timing"].items():
+                    metrics["timing"].setdefault(key, []).append(value)
             
-            for key in metric_fcns.keys():
-                losses = evaluate_multistep(y_valid, 
-                                            y_pred_valid, 
-                                            metric_fcns[key])
-                metrics["valid"][key].append(losses)
-                
-            del y_pred_valid, losses, X_train, y_train
-               
-            # load new data
-            X_train_valid, y_train_valid = data_model.getDataSet(data_model.cross_sets[cross_set]["train_valid"][-1:], scale=True, shuffle=shuffle) 
+                # running objective over the folds so far
+                fold_objectives[f"fold_objective_{num}"] = 2 - np.mean([np.mean(metrics["valid"]["kge"][x]) + np.mean(metrics["valid"]["nse"][x]) for x in range(num+1)])
             
-            print("retrain model with new data")
-            # reset learning rate to half of initial value
-            K.set_value(model.optimizer.learning_rate, hp["lr"]/2)
+                # verbose
+                print_metrics_valid = [np.mean(metrics["valid"][x][num]) for x in ["kge", "nse", "bias"]]
+                print_metrics_test  = [np.mean(metrics["test" ][x][num]) for x in ["kge", "nse", "bias"]]
             
-            # continue training with validation set   
-            model.fit(X_train_valid, y_train_valid, 
-                      epochs     = hp["retrain_epochs"], 
-                      batch_size = hp["batch_size"],
-                      callbacks = TensorBoardCallback,
-                      verbose    = 1,
-                      workers    = 4,
-                      use_multiprocessing=True)
+                print(f"valid kge - nse - bias: {[f'{x:6.4f}' for x in print_metrics_valid]}")
+                print(f"test  kge - nse - bias: {[f'{x:6.4f}' for x in print_metrics_test]}")
             
-            del X_train_valid, y_train_valid
+                # stop hopeless trials early
+                if (prune_percentile is not None) and (prune_min_folds <= num+1 < total_num_of_folds):
+                    if self.should_prune(trial, num, fold_objectives[f"fold_objective_{num}"], prune_percentile, prune_min_trials):
+                        print(f"trial pruned after fold {num}")
+                        fold_results.close()
+                        pruned = True
+                        break
             
-            # evaluate on testing set
-            print("evaluate model performence")
+            num_of_folds = len(fold_objectives)
+            obj_losses = np.mean([np.mean(metrics["valid"]["kge"][x]) + np.mean(metrics["valid"]["nse"][x]) for x in range(num_of_folds)])
             
-            # load new data
-            X_test,  y_test  = data_model.getDataSet(data_model.cross_sets[cross_set]["test"], scale=True, shuffle=False) 
+            print(f"objective loss: {2 - obj_losses}")
             
-            # get simulation and measured values 
-            _, _, yidx = data_model.sets[data_model.cross_sets[cross_set]["test"]]
+            # remaining fold artifacts, background is the busy time of the writer thread
+            with stage_timer(timing, "artifacts_drain"):
+                artifacts.drain()
+            timing["artifacts_background"] = artifacts.busy
             
-            y_pred_test = model.predict(X_test, 
-                                        batch_size = hp["batch_size"], 
-                                        workers = 4,
-                                        use_multiprocessing=True)
-
-            for key in metric_fcns.keys():
-                losses = evaluate_multistep(y_test, 
-                                            y_pred_test, 
-                                            metric_fcns[key])
-                metrics["test"][key].append(losses)
-                
-            del losses 
-            
-            # save fold model
-            if save_fold_models:
-                self.save_model_fold(trial, num, model)
-
-            # save fold forecast data
-            y_pred_test = y_pred_test
-            if save_fold_prediction:
-                np.savetxt(os.path.join(current_log_path, f"pred_fold_{num}.txt"),
-                          y_pred_test, delimiter=",")
-            
-            # plotting
-            if plot_fold_rst:
-                fig, ax = plt.subplots(1,1,figsize=(16,9))
-                ax.set_title(f'fold {num}')
-                ax.set_ylabel('q')
-                ax.set_xlabel('step')
-                
-                tt_test = np.arange(len(y_test))
-                
-                pred00 = y_pred_test[:,0].reshape(-1,1)
-                pred95 = y_pred_test[:,-1].reshape(-1,1)
-                
-                ax.plot(tt_test,    y_test[:,0,0], 'gray')
-                ax.plot(tt_test,    pred00, 'blue', label="1-step-forecast")
-                ax.plot(tt_test+95, pred95,'green', label="96-step-forecast")
-                
-                ax.legend()
-                fig.show()
-
-                fig.savefig(os.path.join(self.tb_log_path, 
-                                         "logs", 
-                                         "trial_"+f"{trial.trial_id}",
-                                         f"eval_fold_{num}.png"), 
-                            dpi = 120,
-                            )
-                plt.pause(0.001)
-                
-                idx_peak = np.argmax(y_test[:,0])
-                ax.set_xlim((tt_test[idx_peak]-24, tt_test[idx_peak]+24))
-                
-                fig.show()
-                fig.savefig(os.path.join(self.tb_log_path, 
-                                         "logs", 
-                                         "trial_"+f"{trial.trial_id}",
-                                         f"eval_fold_{num}_peak.png"), 
-                            dpi = 120,
-                            )
-                
-                plt.pause(0.001)
-                plt.close('all')
-                del fig
+            stages = ["data_load", "get_data", "fit", "predict", "retrain", "metrics", "artifacts", "artifacts_drain", "artifacts_background"]
+            print("timing [s]: " + ", ".join([f"{key} {np.sum(timing[key]):.2f}" for key in stages]))
             
-            # delete variables
-            del X_test, y_test, y_pred_test
+            # save loss values, walk forward metrics are kept apart to compare both modes
+            tag = "_walk_forward" if walk_forward else ""
+            artifacts.submit(save_json, os.path.join(current_log_path, f"metrics{tag}.txt"), metrics)
             
             # write for tensorboard
-            with tf.summary.create_file_writer(current_log_path).as_default():
-                for key in ["kge", "nse"]:
-                    tf.summary.scalar(f'{key}_fold_{num}',  np.mean(metrics["test"][key][num]), step=1)
-                    
-            # verbose
- 
-            print_metrics_valid = [np.mean(metrics["valid"][x][num]) for x in ["kge", "nse", "bias"]]
-            print_metrics_test  = [np.mean(metrics["test" ][x][num]) for x in ["kge", "nse", "bias"]]
-            
-            print(f"valid kge - nse - bias: {[f'{x:6.4f}' for x in print_metrics_valid]}")
-            print(f"test  kge - nse - bias: {[f'{x:6.4f}' for x in print_metrics_test]}")
-
-        obj_losses = np.mean([np.mean(metrics["valid"]["kge"][x]) + np.mean(metrics["valid"]["nse"][x]) for x in range(total_num_of_folds)])
-        
-        print(f"objective loss: {2 - obj_losses}")
-        
-        # save loss values
-        with open(os.path.join(current_log_path, "metrics.txt"), "w+") as f:
-            json.dump(metrics, f)
-        
-        # write for tensorboard
-        num_trainable     = int(np.sum([p.numpy().size for p in model.trainable_weights]))
-        num_non_trainable = int(np.sum([p.numpy().size for p in model.non_trainable_weights]))
-        with tf.summary.create_file_writer(current_log_path).as_default():
-            tf.summary.scalar("trial_id",      np.float64(trial.trial_id), step=1)
-            tf.summary.scalar("trainable",     num_trainable, step=1)
-            tf.summary.scalar("non_trainable", num_non_trainable, step=1)
+            num_trainable     = int(np.sum([p.numpy().size for p in model.trainable_weights]))
+            num_non_trainable = int(np.sum([p.numpy().size for p in model.non_trainable_weights]))
+            scalars = {"trial_id":      np.float64(trial.trial_id),
+                       "trainable":     num_trainable,
+                       "non_trainable": num_non_trainable,
+                       "folds":         num_of_folds,
+                       "samples_per_sec": np.mean([x for fold in timing["samples_per_sec"] for x in fold]),
+                       "step_time":       np.mean([x for fold in timing["step_time"] for x in fold]),
+                       }
+            for key in stages:
+                scalars[f"time_{key}"] = np.sum(timing[key])
             for key in ["kge", "nse"]:
                 for on_set in ["valid", "test"]:
                     m = np.mean(metrics[on_set][key])
-                    tf.summary.scalar(f"{key}_{on_set}",  m, step=1)
+                    scalars[f"{key}_{on_set}{tag}"] = m
                     print(f"{on_set}: {m:6.4f}")
+            artifacts.submit(write_scalars, artifacts.summary_writer(current_log_path), scalars)
+            
+            # save final model
+            self.save_model(trial, model)
+            
+            # all artifacts are written before the trial ends
+            artifacts.drain()
+        finally:
+            artifacts.close()
         
-        # save final model
-        self.save_model(trial, model)
-        
-        return 2 - obj_losses
+        # the running objectives are kept by the oracle for pruning later trials
+        if pruned:
+            return {"val_loss": self.pruned_score(trial, 2 - obj_losses), "pruned": 1.0, **fold_objectives}
+        return {"val_loss": 2 - obj_losses, **fold_objectives}
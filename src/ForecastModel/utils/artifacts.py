@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Manuel Pirker
+"""
+
+#############################
+#         Imports
+#############################
+import os
+import json
+import queue
+import threading
+from time import perf_counter
+
+import numpy as np
+import tensorflow as tf
+from matplotlib.figure import Figure
+
+#############################
+#         Functions
+#############################
+def write_scalars(writer, scalars, step=1):
+    with writer.as_default():
+        for key, value in scalars.items():
+            tf.summary.scalar(key, value, step=step)
+
+def save_json(path, obj):
+    with open(path, "w+") as f:
+        json.dump(obj, f)
+
+def plot_fold(path, num, y_test, y_pred_test):
+    # figure without pyplot, so it can be drawn outside of the main thread
+    fig = Figure(figsize=(16,9))
+    ax  = fig.subplots(1,1)
+    ax.set_title(f'fold {num}')
+    ax.set_ylabel('q')
+    ax.set_xlabel('step')
+
+    tt_test = np.arange(len(y_test))
+
+    pred00 = y_pred_test[:,0].reshape(-1,1)
+    pred95 = y_pred_test[:,-1].reshape(-1,1)
+
+    ax.plot(tt_test,    y_test[:,0,0], 'gray')
+    ax.plot(tt_test,    pred00, 'blue', label="1-step-forecast")
+    ax.plot(tt_test+95, pred95,'green', label="96-step-forecast")
+
+    ax.legend()
+    fig.savefig(os.path.join(path, f"eval_fold_{num}.png"), dpi = 120)
+
+    idx_peak = np.argmax(y_test[:,0])
+    ax.set_xlim((tt_test[idx_peak]-24, tt_test[idx_peak]+24))
+    fig.savefig(os.path.join(path, f"eval_fold_{num}_peak.png"), dpi = 120)
+
+#############################
+#         Classes
+#############################
+class ArtifactWriter:
+    # writes plots, predictions and summaries in a background thread, models are
+    # saved by the caller. submit blocks while max_queue artifacts are pending
+    def __init__(self, max_queue=8):
+        self.queue   = queue.Queue(maxsize=max_queue)
+        self.writers = {}
+        self.errors  = []
+        self.busy    = 0.0
+        self.thread  = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                break
+
+            fcn, args, kwargs = task
+            t0 = perf_counter()
+            try:
+                fcn(*args, **kwargs)
+            except Exception as e:
+                self.errors.append(e)
+            self.busy += perf_counter() - t0
+            self.queue.task_done()
+
+    def submit(self, fcn, *args, **kwargs):
+        self.queue.put((fcn, args, kwargs))
+
+    def summary_writer(self, path):
+        # one summary writer per log directory
+        if path not in self.writers:
+            self.writers[path] = tf.summary.create_file_writer(path)
+        return self.writers[path]
+
+    def drain(self):
+        # waits for the pending artifacts and raises the first error
+        self.queue.join()
+        if self.errors:
+            error, self.errors = self.errors[0], []
+            raise error
+
+    def close(self):
+        # stops the thread, closes the summary writers and raises the first error
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        self.drain()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Manuel Pirker
+"""
+
+#############################
+#         Imports
+#############################
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+from .metrics import MetricAccumulator, MultistepMetrics, multistep_arrays
+
+#############################
+#         Init
+#############################
+# block sums shared with the worker processes of bootstrap_ci
+WORKER_STATS = {}
+
+#############################
+#         Functions
+#############################
+def cumulative_sums(obs_multistep, pred_multistep, out=None):
+    # cumulative sums (n+1, 7*n_leadtimes) of the per sample count, sums, squares, 
+    # cross product and squared error, written into out if given. The series 
+    # is shifted by its column means so the moments do not cancel
+    obs, pred = multistep_arrays(obs_multistep, pred_multistep)
+    n, n_leadtimes = obs.shape
+
+    valid = ~(np.isnan(obs) | np.isnan(pred))
+    shift_obs, shift_pred = np.nanmean(obs, axis=0), np.nanmean(pred, axis=0)
+    dev_obs  = np.where(valid, obs  - shift_obs,  0)
+    dev_pred = np.where(valid, pred - shift_pred, 0)
+
+    cumsum = np.empty((n + 1, 7*n_leadtimes)) if out is None else out
+    cumsum[0] = 0
+    quantities = [valid, dev_obs, dev_pred, dev_obs**2, dev_pred**2, dev_obs*dev_pred, np.where(valid, pred - obs, 0)**2]
+    for k, quantity in enumerate(quantities):
+        np.cumsum(quantity, axis=0, out=cumsum[1:, k*n_leadtimes:(k+1)*n_leadtimes])
+    return cumsum, shift_obs, shift_pred
+
+def block_sums(cumsum, block_len):
+    # turns the cumulative sums in place into the sums of every block of block_len
+    # samples and returns them as view (n_starts, 7*n_leadtimes). The rows are 
+    # updated from the end in chunks that do not overlap the rows they read
+    n = cumsum.shape[0] - 1
+    for end in range(n + 1, block_len, -block_len):
+        start = max(block_len, end - block_len)
+        cumsum[start:end] -= cumsum[start - block_len:end - block_len]
+    return cumsum[block_len:]
+
+def block_layout(n, block_len):
+    # the last block of a resample is cut to the length of the series
+    block_len = min(block_len, n)
+    n_blocks  = int(np.ceil(n / block_len))
+    return block_len, n_blocks, n - (n_blocks - 1) * block_len
+
+def resample_metrics(blocks, tails, rng, n_blocks, shift_obs, shift_pred, metric_keys):
+    # metrics (n_resamples, n_leadtimes) of moving block resamples, tails are 
+    # the sums of the cut last blocks (n_resamples, 7*n_leadtimes)
+    starts = rng.integers(0, blocks.shape[0], (tails.shape[0], n_blocks - 1))
+
+    sums = tails
+    for n in range(starts.shape[1]):
+        sums += blocks[starts[:,n]]
+
+    count, sum_obs, sum_pred, sq_obs, sq_pred, cross, sse = np.split(sums, 7, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        state = {"count"    : count,
+                 "mean_obs" : shift_obs  + sum_obs  / count,
+                 "mean_pred": shift_pred + sum_pred / count,
+                 "m2_obs"   : sq_obs  - sum_obs**2  / count,
+                 "m2_pred"  : sq_pred - sum_pred**2 / count,
+                 "comoment" : cross - sum_obs * sum_pred / count,
+                 "sse"      : sse,
+                 }
+        accumulator = MetricAccumulator().combine(state)
+        return {key: getattr(accumulator, key)() for key in metric_keys}
+
+def init_worker(name, shape, block_len, n_blocks, shift_obs, shift_pred):
+    # process pool initializer: maps the block sums of the parent process
+    shm = shared_memory.SharedMemory(name=name)
+    WORKER_STATS.update(shm=shm, blocks=np.ndarray(shape, dtype=np.float64, buffer=shm.buf)[block_len:], 
+                        n_blocks=n_blocks, shift_obs=shift_obs, shift_pred=shift_pred)
+
+def bootstrap_chunk(rng, tails, metric_keys):
+    stats = WORKER_STATS
+    return resample_metrics(stats["blocks"], tails, rng, stats["n_blocks"], stats["shift_obs"], stats["shift_pred"], metric_keys)
+
+def bootstrap_ci(obs_multistep, pred_multistep, n_resamples=1000, block_len=96, ci=0.9,
+                 metric_keys=("nse", "kge", "bias", "rmse"), n_workers=1, chunk_size=50, seed=None):
+    # moving block bootstrap confidence bands of the metrics per lead time,
+    # block_len=96 keeps days of the 15 minute series together. The resamples
+    # are drawn in chunks with their own seeds, so the bands do not depend on n_workers
+    n_chunks = int(np.ceil(n_resamples / chunk_size))
+    rngs     = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n_chunks)]
+    sizes    = [min(chunk_size, n_resamples - n*chunk_size) for n in range(n_chunks)]
+
+    n, n_leadtimes = np.shape(pred_multistep)
+    block_len, n_blocks, tail_len = block_layout(n, block_len)
+    shape = (n + 1, 7*n_leadtimes)
+
+    # the statistics are computed once, with workers directly in shared memory
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape))*8) if n_workers > 1 else None
+    try:
+        out = None if shm is None else np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        cumsum, shift_obs, shift_pred = cumulative_sums(obs_multistep, pred_multistep, out)
+
+        # sums of the cut last blocks, drawn before the cumulative sums become block sums
+        tails = []
+        for rng, size in zip(rngs, sizes):
+            starts = rng.integers(0, n - tail_len + 1, size)
+            tails.append(cumsum[starts + tail_len] - cumsum[starts])
+        blocks = block_sums(cumsum, block_len)
+        del cumsum
+
+        if shm is None:
+            chunks = [resample_metrics(blocks, t, rng, n_blocks, shift_obs, shift_pred, metric_keys) for rng, t in zip(rngs, tails)]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers,
+                                     mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=init_worker,
+                                     initargs=(shm.name, shape, block_len, n_blocks, shift_obs, shift_pred)) as executor:
+                chunks = list(executor.map(bootstrap_chunk, rngs, tails, [metric_keys]*n_chunks))
+    finally:
+        if shm is not None:
+            # views into the shared buffer are released before it is closed
+            out = cumsum = blocks = None
+            shm.close()
+            shm.unlink()
+
+    estimate = MultistepMetrics(obs_multistep, pred_multistep)
+    bands = {"estimate": {}, "lower": {}, "upper": {}}
+    for key in metric_keys:
+        samples = np.concatenate([chunk[key] for chunk in chunks], axis=0)
+        lower, upper = np.nanpercentile(samples, [50*(1-ci), 50*(1+ci)], axis=0)
+        bands["estimate"][key] = getattr(estimate, key)().tolist()
+        bands["lower"][key]    = lower.tolist()
+        bands["upper"][key]    = upper.tolist()
+    return bands
+
+def bootstrap_sets(sets, **kwargs):
+    # bands of several series, e.g. sets[(model, fold)] = (obs, pred)
+    return {key: bootstrap_ci(obs, pred, **kwargs) for key, (obs, pred) in sets.items()}
@@ -10,24 +10,48 @@
 import numpy as np
 import os
 import json
+from functools import cached_property
 
 #############################
 #         Functions
 #############################
 # helper functions
-def get_n_peaks(df, col_eval, n_peaks, window):
-    peaks = []
-    df_length = df.shape[0]
+def find_peak_windows(values, n_peaks, before, after):
+    # positions of the n_peaks largest peaks and their windows, each window 
+    # covers before rows ahead of and after rows from the peak on, counted 
+    # among the rows not taken by an earlier window. nan values are skipped
+    # and ties go to the first occurrence, like repeated argmax and drop
+    values = np.asarray(values, dtype=np.float64)
+    
+    # descending, stable and nan last, so sorted once for all peaks
+    order     = np.argsort(-values, kind="stable")
+    n_valid   = np.count_nonzero(~np.isnan(values))
+    remaining = np.ones(values.shape[0], dtype=bool)
+    n_removed = 0
+    
+    windows = []
+    i_order = 0
     for n_peak in range(n_peaks):
-        i_max   = df[col_eval].argmax()
-        i_start = np.max([0, i_max - window//2])
-        i_end   = np.min([df_length, i_max + window//2])
+        while i_order < n_valid and not remaining[order[i_order]]:
+            i_order += 1
+        if i_order == n_valid:
+            raise ValueError(f"found {n_peak} of {n_peaks} peaks, no values left")
+        i_max = order[i_order]
         
-        peaks.append(df.iloc[i_start:i_end])
+        # a range holding n remaining rows is at most n + n_removed long
+        lo = max(0, i_max - before - n_removed)
+        ahead  = lo + np.flatnonzero(remaining[lo:i_max])[-before:] if before > 0 else np.array([], dtype=np.int64)
+        behind = i_max + np.flatnonzero(remaining[i_max:i_max + after + n_removed])[:after]
+        window = np.concatenate([ahead, behind])
         
-        df = df.drop(df.index[i_start:i_end], axis=0)
+        remaining[window] = False
+        n_removed += window.shape[0]
+        windows.append(window)
     
-    return peaks
+    return windows
+
+def get_n_peaks(df, col_eval, n_peaks, window):
+    return [df.iloc[idx] for idx in find_peak_windows(df[col_eval].to_numpy(), n_peaks, window//2, window//2)]
 
 def extract_arima_metrics(path):
     with open(os.path.join(path, "model.json"),"r") as f:
@@ -74,6 +98,9 @@ def find_best_model(directory, metric_key="kge"):
 # evaluate over forecasting horizont
 def evaluate_multistep(obs_multistep, pred_multistep, loss_function):
     # print((obs_multistep.shape), pred_multistep.shape)
+    # evaluate in double precision, model inputs and outputs are float32
+    obs_multistep  = np.asarray(obs_multistep,  dtype=np.float64)
+    pred_multistep = np.asarray(pred_multistep, dtype=np.float64)
     if obs_multistep.shape[1] == pred_multistep.shape[1]:
         step_losses = [loss_function(obs_multistep[:,x,0], pred_multistep[:,x]) 
                        for x in range(pred_multistep.shape[1])] 
@@ -83,6 +110,38 @@ def evaluate_multistep(obs_multistep, pred_multistep, loss_function):
 
     return step_losses
 
+def multistep_arrays(obs_multistep, pred_multistep):
+    # (n_samples, n_leadtimes) double precision observations and predictions
+    obs  = np.asarray(obs_multistep,  dtype=np.float64)
+    pred = np.asarray(pred_multistep, dtype=np.float64)
+    if obs.shape[1] == pred.shape[1]:
+        obs = obs.reshape(obs.shape[0], obs.shape[1])
+    else:
+        # single step observations, compared to every lead time
+        obs = np.repeat(obs.reshape(obs.shape[0], -1)[:,:1], pred.shape[1], axis=1)
+    return obs, pred
+
+def evaluate_multistep_batched(obs_multistep, pred_multistep, metric_fcns):
+    # all metrics of all lead times at once, metric_fcns maps names to the 
+    # calculate_* functions, functions without batched version are looped
+    stats = MultistepMetrics(obs_multistep, pred_multistep)
+    
+    step_losses = {}
+    for key, fcn in metric_fcns.items():
+        if fcn in BATCHED_METRICS:
+            step_losses[key] = list(getattr(stats, BATCHED_METRICS[fcn])())
+        else:
+            step_losses[key] = evaluate_multistep(obs_multistep, pred_multistep, fcn)
+    return step_losses
+
+def evaluate_streaming(predict_fcn, batches, accumulator=None):
+    # accumulates the metrics batch by batch, batches yields (X, y) like a 
+    # DataSequence and predict_fcn maps X to the predictions
+    accumulator = MetricAccumulator() if accumulator is None else accumulator
+    for X, y in batches:
+        accumulator.update(y, predict_fcn(X))
+    return accumulator
+
 #%% metrics
 def calculate_rms(observed, predicted):
     return np.sqrt(np.mean((observed - predicted)**2))
@@ -149,28 +208,54 @@ def calculate_bias(observations, predictions):
     
     return pbias
 
-def calculate_bias_fhv(observations, predictions, exceedance_prob = 0.02):
-    num_total = observations.shape[0]
+def fdc_arrays(observations, predictions, axis=None):
+    # flattened arrays, or with axis the columns along the contiguous last axis
+    if axis is None:
+        return observations.flatten(), predictions.flatten(), observations.shape[0]
+    num_total = observations.shape[axis]
+    observations = np.ascontiguousarray(np.moveaxis(observations, axis, -1))
+    predictions  = np.ascontiguousarray(np.moveaxis(predictions,  axis, -1))
+    return observations, predictions, num_total
+
+def sorted_largest(x, num):
+    # np.sort(x, axis=-1)[..., -num:], small selections are taken with 
+    # np.partition first so only the selected values are sorted
+    n = x.shape[-1]
+    if num == 0 or 4*num > n:
+        return np.sort(x, axis=-1)[..., n-num if num > 0 else 0:]
+    return np.sort(np.partition(x, n - num, axis=-1)[..., n-num:], axis=-1)
+
+def sorted_smallest(x, num):
+    # np.sort(x, axis=-1)[..., :num]
+    n = x.shape[-1]
+    if num == 0 or 4*num > n:
+        return np.sort(x, axis=-1)[..., :num]
+    return np.sort(np.partition(x, num - 1, axis=-1)[..., :num], axis=-1)
+
+def calculate_bias_fhv(observations, predictions, exceedance_prob = 0.02, axis=None):
+    # axis=None evaluates the flattened arrays, otherwise every column along axis
+    observations, predictions, num_total = fdc_arrays(observations, predictions, axis)
     num_hv    = int(num_total * exceedance_prob)
 
-    observations_hv = np.sort(observations.flatten())[-num_hv:]
-    predictions_hv  = np.sort(predictions.flatten())[-num_hv:]
-    
     # sort ascending
-    numerator   = np.sum(predictions_hv - observations_hv)
-    denominator = np.sum(observations_hv)
+    observations_hv = sorted_largest(observations, num_hv)
+    predictions_hv  = sorted_largest(predictions,  num_hv)
+    
+    numerator   = np.sum(predictions_hv - observations_hv, axis=-1)
+    denominator = np.sum(observations_hv, axis=-1)
     
     fhv_pbias = (numerator / denominator) * 100
     
     return fhv_pbias
     
-def calculate_bias_flv(observations, predictions, exceedance_prob = 0.7):
-    num_total = observations.shape[0]
+def calculate_bias_flv(observations, predictions, exceedance_prob = 0.7, axis=None):
+    # axis=None evaluates the flattened arrays, otherwise every column along axis
+    observations, predictions, num_total = fdc_arrays(observations, predictions, axis)
     num_lv    = int(num_total * (1-exceedance_prob))
 
     # sort ascending
-    predictions_lv  = np.sort(predictions.flatten())[:num_lv]   
-    observations_lv = np.sort(observations.flatten())[:num_lv]
+    predictions_lv  = sorted_smallest(predictions,  num_lv)
+    observations_lv = sorted_smallest(observations, num_lv)
 
     # replace values close to 0 due to numerical reasons
     observations_lv[observations_lv <= 1e-6] = 1e-6
@@ -180,9 +265,210 @@ def calculate_bias_flv(observations, predictions, exceedance_prob = 0.7):
     # observations_lv  = np.log(observations_lv)
     # predictions_lv   = np.log(predictions_lv)
     
-    obs  = np.sum(observations_lv - np.min(observations_lv))
-    pred = np.sum(predictions_lv  - np.min(predictions_lv))
+    obs  = np.sum(observations_lv - np.min(observations_lv, axis=-1, keepdims=True), axis=-1)
+    pred = np.sum(predictions_lv  - np.min(predictions_lv,  axis=-1, keepdims=True), axis=-1)
     
     flv_pbias = -1 * ((pred - obs) / (obs + 1e-6)) * 100
     
-    return flv_pbias
\ No newline at end of file
+    return flv_pbias
+
+#############################
+#         Classes
+#############################
+class MultistepMetrics:
+    # metrics of all lead times from shared statistics, the lead times are the 
+    # contiguous rows of (n_leadtimes, n_samples) arrays, so every reduction 
+    # sums in the same order as the calculate_* functions on one column
+    def __init__(self, obs_multistep, pred_multistep):
+        obs, pred = multistep_arrays(obs_multistep, pred_multistep)
+        
+        self.obs  = np.ascontiguousarray(obs.T)
+        self.pred = np.ascontiguousarray(pred.T)
+        self.n    = self.obs.shape[1]
+    
+    # shared statistics
+    @cached_property
+    def sum_obs(self):
+        return self.obs.sum(axis=-1)
+    
+    @cached_property
+    def sum_pred(self):
+        return self.pred.sum(axis=-1)
+    
+    @cached_property
+    def sum_squared_error(self):
+        return ((self.pred - self.obs)**2).sum(axis=-1)
+    
+    @cached_property
+    def sum_squared_dev_obs(self):
+        return ((self.obs - (self.sum_obs / self.n)[:,None])**2).sum(axis=-1)
+    
+    @cached_property
+    def sum_squared_dev_pred(self):
+        return ((self.pred - (self.sum_pred / self.n)[:,None])**2).sum(axis=-1)
+    
+    @cached_property
+    def std_obs(self):
+        return np.sqrt(self.sum_squared_dev_obs / self.n)
+    
+    @cached_property
+    def std_pred(self):
+        return np.sqrt(self.sum_squared_dev_pred / self.n)
+    
+    @cached_property
+    def kge_means(self):
+        # means as used by the KGE, nan ignoring and at least 1e-6
+        return (np.fmax(np.nanmean(self.obs,  axis=-1), 1e-6), 
+                np.fmax(np.nanmean(self.pred, axis=-1), 1e-6))
+    
+    # metrics, one value per lead time
+    def rmse(self):
+        return np.sqrt(self.sum_squared_error / self.n)
+    
+    def nse(self):
+        return 1 - self.sum_squared_error / self.sum_squared_dev_obs
+    
+    def bias(self):
+        return (np.sum(self.pred - self.obs, axis=-1) / self.sum_obs) * 100
+    
+    def kge_linear(self):
+        m1, m2 = self.kge_means
+        dev_obs  = self.obs  - m1[:,None]
+        dev_pred = self.pred - m2[:,None]
+        return np.sum(dev_obs * dev_pred, axis=-1) / (np.sqrt(np.sum(dev_obs ** 2, axis=-1)) * np.sqrt(np.sum(dev_pred ** 2, axis=-1)))
+    
+    def kge_bias(self):
+        m1, m2 = self.kge_means
+        return m2 / m1
+    
+    def kge_var(self):
+        m1, m2 = self.kge_means
+        return (self.std_pred / m2) / (self.std_obs / m1)
+    
+    def kge(self):
+        r, beta, gamma = self.kge_linear(), self.kge_bias(), self.kge_var()
+        return 1 - np.sqrt((r - 1) ** 2 + (beta - 1) ** 2 + (gamma - 1) ** 2)
+    
+    def kge5alpha(self):
+        r, beta = self.kge_linear(), self.kge_bias()
+        alpha = self.std_pred / self.std_obs
+        return 1 - np.sqrt((r - 1) ** 2 + (2*(alpha - 1)) ** 2 + (beta - 1) ** 2)
+    
+    def bias_fhv(self, exceedance_prob = 0.02):
+        return calculate_bias_fhv(self.obs, self.pred, exceedance_prob, axis=-1)
+    
+    def bias_flv(self, exceedance_prob = 0.7):
+        return calculate_bias_flv(self.obs, self.pred, exceedance_prob, axis=-1)
+
+class MetricAccumulator:
+    # streaming statistics per lead time, updated from batches of (obs, pred) 
+    # and mergeable across batches, folds or processes. Means, squared 
+    # deviations and the co-moment are combined with the pairwise update of 
+    # Chan et al., sample pairs with a nan are skipped
+    def __init__(self):
+        self.count = None
+    
+    @staticmethod
+    def batch_statistics(obs, pred):
+        valid = ~(np.isnan(obs) | np.isnan(pred))
+        count = valid.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_obs  = np.where(valid, obs,  0).sum(axis=0) / count
+            mean_pred = np.where(valid, pred, 0).sum(axis=0) / count
+        
+        dev_obs  = np.where(valid, obs  - mean_obs,  0)
+        dev_pred = np.where(valid, pred - mean_pred, 0)
+        
+        return {"count"    : count.astype(np.float64),
+                "mean_obs" : np.nan_to_num(mean_obs),
+                "mean_pred": np.nan_to_num(mean_pred),
+                "m2_obs"   : (dev_obs**2).sum(axis=0),
+                "m2_pred"  : (dev_pred**2).sum(axis=0),
+                "comoment" : (dev_obs*dev_pred).sum(axis=0),
+                "sse"      : (np.where(valid, pred - obs, 0)**2).sum(axis=0),
+                }
+    
+    def state(self):
+        return {key: getattr(self, key) for key in ["count", "mean_obs", "mean_pred", "m2_obs", "m2_pred", "comoment", "sse"]}
+    
+    def combine(self, other):
+        # merges the statistics dict other into the accumulator
+        if self.count is None:
+            for key, value in other.items():
+                setattr(self, key, np.array(value, dtype=np.float64))
+            return self
+        
+        count = self.count + other["count"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.nan_to_num(other["count"] / count)
+            factor = np.nan_to_num(self.count * other["count"] / count)
+        delta_obs  = other["mean_obs"]  - self.mean_obs
+        delta_pred = other["mean_pred"] - self.mean_pred
+        
+        self.mean_obs  = self.mean_obs  + delta_obs  * weight
+        self.mean_pred = self.mean_pred + delta_pred * weight
+        self.m2_obs    = self.m2_obs   + other["m2_obs"]   + delta_obs**2  * factor
+        self.m2_pred   = self.m2_pred  + other["m2_pred"]  + delta_pred**2 * factor
+        self.comoment  = self.comoment + other["comoment"] + delta_obs * delta_pred * factor
+        self.sse       = self.sse + other["sse"]
+        self.count     = count
+        return self
+    
+    def update(self, obs_multistep, pred_multistep):
+        # obs and pred shaped like for evaluate_multistep
+        return self.combine(self.batch_statistics(*multistep_arrays(obs_multistep, pred_multistep)))
+    
+    def merge(self, other):
+        if other.count is None:
+            return self
+        return self.combine(other.state())
+    
+    # metrics, one value per lead time
+    def rmse(self):
+        return np.sqrt(self.sse / self.count)
+    
+    def nse(self):
+        return 1 - self.sse / self.m2_obs
+    
+    def bias(self):
+        return (self.mean_pred - self.mean_obs) / self.mean_obs * 100
+    
+    def kge_means(self):
+        return np.fmax(self.mean_obs, 1e-6), np.fmax(self.mean_pred, 1e-6)
+    
+    def kge_linear(self):
+        # correlation around the clipped means, as in calculate_kge
+        m1, m2 = self.kge_means()
+        shift_obs, shift_pred = self.mean_obs - m1, self.mean_pred - m2
+        cross    = self.comoment + self.count * shift_obs * shift_pred
+        ss_obs   = self.m2_obs   + self.count * shift_obs**2
+        ss_pred  = self.m2_pred  + self.count * shift_pred**2
+        return cross / (np.sqrt(ss_obs) * np.sqrt(ss_pred))
+    
+    def kge_bias(self):
+        m1, m2 = self.kge_means()
+        return m2 / m1
+    
+    def kge_var(self):
+        m1, m2 = self.kge_means()
+        return (np.sqrt(self.m2_pred / self.count) / m2) / (np.sqrt(self.m2_obs / self.count) / m1)
+    
+    def kge(self):
+        r, beta, gamma = self.kge_linear(), self.kge_bias(), self.kge_var()
+        return 1 - np.sqrt((r - 1) ** 2 + (beta - 1) ** 2 + (gamma - 1) ** 2)
+    
+    def results(self, metric_keys=("nse", "kge", "bias", "rmse")):
+        return {key: getattr(self, key)().tolist() for key in metric_keys}
+
+# calculate_* functions with a MultistepMetrics counterpart
+BATCHED_METRICS = {calculate_rms:        "rmse",
+                   calculate_nse:        "nse",
+                   calculate_bias:       "bias",
+                   calculate_kge:        "kge",
+                   calculate_kge_var:    "kge_var",
+                   calculate_kge_bias:   "kge_bias",
+                   calculate_kge_linear: "kge_linear",
+                   calculate_kge5alpha:  "kge5alpha",
+                   calculate_bias_fhv:   "bias_fhv",
+                   calculate_bias_flv:   "bias_flv",
+                   }
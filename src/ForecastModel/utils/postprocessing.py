@@ -12,6 +12,8 @@ import numpy as np
 import json
 import pandas as pd
 
+from .metrics import find_peak_windows
+
 #############################
 #         Functions
 #############################
@@ -71,70 +73,52 @@ def get_bold_mask(df, fcn=np.argmax, n_multi_cols=3, offset=0):
             mask[j, idx[j]*n_multi_cols+n+offset] = 1
     return mask
 
-def find_best_models(data_lstm, data_arima):
-    # OBSOLETE
-    all_best = []
-    normalized_arima = []
-    normalized_lstm = []
-    normalized_hydro = []
+def compare_models(obs, preds):
+    # compares any number of models sample by sample, obs (n_samples, n_leadtimes)
+    # and preds a list of (n_samples, n_leadtimes) predictions
+    obs = np.asarray(obs)
+    obs = obs.reshape(obs.shape[0], -1)
+    abs_errors = np.stack([np.abs(obs - np.asarray(pred)) for pred in preds], axis=0)
+    n_models   = abs_errors.shape[0]
     
-    all_absolute_errors_arima = []
-    all_absolute_errors_lstm = []
+    # better[m, o]: model m has a strictly lower error than model o
+    better = abs_errors[:,None] < abs_errors[None,:]
+    better[np.arange(n_models), np.arange(n_models)] = True
     
+    # a sample is won by a model better than all others, ties are not counted
+    wins = better.all(axis=1).sum(axis=1)
+    
+    # rank = number of strictly better models, tied models share the better rank
+    ranks = better.sum(axis=0) - 1
+    rank_counts = np.stack([(ranks == k).sum(axis=1) for k in range(n_models)], axis=1)
+    
+    return {"wins"       : wins,                            # (n_models, n_leadtimes)
+            "win_rate"   : wins / wins.sum(axis=0),         # share of the won samples
+            "rank_counts": rank_counts,                     # (n_models, n_ranks, n_leadtimes)
+            "rank_dist"  : rank_counts / abs_errors.shape[1],
+            "abs_errors" : abs_errors,                      # (n_models, n_samples, n_leadtimes)
+            }
 
-    for i in range(0,96):
-        arima_q0 = data_arima['fc%s' % i].values
-        lstm_q0 = data_lstm['q%s' % i].values
-        measured_q0 = data_arima['obs%s' % i].values
-        
-        num_best_arima = 0
-        num_best_lstm = 0
-        num_best_hydro = 0
-        
-        all_abs_error = []
-        all_abs_error2 = []
-
-        for j in range(0,len(arima_q0)):
-            error_arima = abs(measured_q0[j] - arima_q0[j])
-            error_lstm = abs(measured_q0[j] - lstm_q0[j])
-            
-            if error_arima < error_lstm:
-                num_best_arima += 1
-            if error_lstm < error_arima:
-                num_best_lstm += 1
-                
-            
-            all_abs_error.append(error_arima)
-            all_abs_error2.append(error_lstm)
-
-        all_absolute_errors_arima.append(all_abs_error)
-        all_absolute_errors_lstm.append(all_abs_error2)
-
-        list_best = [num_best_arima, num_best_lstm]
+def find_best_models(data_lstm, data_arima):
+    # ARIMA vs LSTM, kept for the notebooks, see compare_models
+    lead_times = range(0,96)
+    obs   = data_arima[['obs%s' % i for i in lead_times]].values
+    arima = data_arima[['fc%s'  % i for i in lead_times]].values
+    lstm  = data_lstm[['q%s'    % i for i in lead_times]].values
     
-        all_best.append(list_best)
+    rst = compare_models(obs, [arima, lstm])
     
-        normalized_arima.append(num_best_arima / (num_best_arima + num_best_lstm))
-        normalized_lstm.append(num_best_lstm / (num_best_arima + num_best_lstm))
-        normalized_hydro.append(num_best_hydro / (num_best_arima + num_best_lstm))
+    all_best = rst["wins"].T.tolist()
+    all_absolute_errors_arima, all_absolute_errors_lstm = rst["abs_errors"].transpose(0, 2, 1).tolist()
     
-    return all_best, np.asarray(normalized_arima), np.asarray(normalized_lstm), all_absolute_errors_arima, all_absolute_errors_lstm
+    return all_best, rst["win_rate"][0], rst["win_rate"][1], all_absolute_errors_arima, all_absolute_errors_lstm
 
 def get_n_peaks(df, col_eval, n_peaks, window):
     # find the n_peaks most prominent peaks in df[col_eval] and returns peak values with the window
-    peaks = []
-    df_length = df.shape[0]
-    for n_peak in range(n_peaks):
-        i_max   = df[col_eval].argmax()
-        i_start = np.max([0, i_max - window//4])
-        i_end   = np.min([df_length, i_max + window])
-        
-        df["n_peak"] = n_peak
-        peaks.append(df.iloc[i_start:i_end].copy())
-        
-        df = df.drop(df.index[i_start:i_end], axis=0)
+    windows = find_peak_windows(df[col_eval].to_numpy(), n_peaks, window//4, window)
     
-    peaks = pd.concat(peaks, axis=0)
+    peaks = df.iloc[np.concatenate(windows)].copy()
+    peaks["n_peak"] = np.repeat(np.arange(n_peaks), [idx.shape[0] for idx in windows])
     return peaks
 
 def dt(dates, format="%d/%m/%Y %H:%M"):
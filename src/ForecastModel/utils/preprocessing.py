@@ -15,28 +15,240 @@ import matplotlib.pyplot as plt
 from sklearn.preprocessing import MinMaxScaler
 
 import pickle
-# import json
+import json
+import hashlib
 
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+#############################
+#         Functions
+#############################
+def find_valid_anchors(timeline, gaps, anchors, set_limit, hincast_len, forecast_len, target_len, dtime_secs=15*60):
+    # keeps the anchors whose windows neither cross a gap nor the set limit [ns]
+    # first and last position touched by any window of a sample
+    i_first = anchors - hincast_len + 1
+    i_last  = anchors + max(forecast_len, target_len)
+    
+    valid = (i_first >= 0) & (i_last < len(timeline))
+    # no missing time step within the window
+    valid[valid] = gaps[i_last[valid]] == gaps[i_first[valid]]
+    # windows must not reach beyond the set limit
+    valid &= timeline[anchors] + forecast_len * np.int64(dtime_secs * 10**9) <= set_limit
+    
+    if np.any(~valid):
+        print(f"{np.sum(~valid)} samples crossing gaps or set limits were removed")
+    
+    return anchors[valid].astype(np.int32)
+
+# arrays shared with the worker processes of CreateIndices.create
+shared_arrays = {}
+
+def attach_shared_arrays(specs):
+    # process pool initializer: maps the timeline, gap index and mask of the parent process
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        shared_arrays[key] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+def build_set_job(hincast_len, n_set, t_start, t_end, set_limit, forecast_len, target_len, dtime_secs):
+    # anchors of one (hincast length, set) job, computed on the shared arrays
+    timeline = shared_arrays["timeline"][1]
+    gaps     = shared_arrays["gaps"][1]
+    mask     = shared_arrays["mask"][1]
+    
+    anchors = np.flatnonzero(mask & (timeline > t_start) & (timeline < t_end))
+    return hincast_len, n_set, find_valid_anchors(timeline, gaps, anchors, set_limit, hincast_len, forecast_len, target_len, dtime_secs)
+
+def read_dataset_csv(csv_path, utc=True):
+    df = pd.read_csv(csv_path, parse_dates=['time'], index_col='time')
+    if utc:
+        if df.index.tz == None:
+            # make TZ aware
+            print("datetimes set to UTC+0000")
+            df.index = df.index.tz_localize("Europe/London", ambiguous='raise').tz_convert("UTC")
+        else:
+            df.index = df.index.tz_convert("UTC")
+    else:
+        df = df.set_index(pd.to_datetime(df.index))
+    return df
+
+def get_file_hash(path, chunk_size=2**20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def get_cache_path(csv_path):
+    return csv_path + ".cache"
+
+def write_json(path, obj):
+    # written to a temporary file and moved into place, readers never see a partial file
+    tmp_file = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_file, path)
+
+def read_json(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+def get_cache_version(csv_path):
+    # returns the cache folder of the current source file or None, the cache 
+    # is keyed by size, mtime and content hash of the file, the hash is only 
+    # recomputed if the size matches but the mtime changed
+    current_file = os.path.join(get_cache_path(csv_path), "current.json")
+    if not os.path.isfile(current_file):
+        return None
+    current = read_json(current_file)
+    version_path = os.path.join(get_cache_path(csv_path), current["sha256"])
+    if not os.path.isfile(os.path.join(version_path, "meta.json")):
+        return None
+    
+    stat = os.stat(csv_path)
+    if stat.st_size != current["size"]:
+        return None
+    if stat.st_mtime_ns != current["mtime_ns"]:
+        if get_file_hash(csv_path) != current["sha256"]:
+            return None
+        current["mtime_ns"] = stat.st_mtime_ns
+        try:
+            write_json(current_file, current)
+        except OSError:
+            # read-only cache, the hash is checked again next time
+            pass
+    return version_path
+
+def build_dataset_cache(csv_path):
+    # converts the csv once into int64 epochs [ns] and one .npy file per column
+    # (float32, boolean columns are kept as bool), other columns such as booleans
+    # with missing values are pickled as parsed from the csv. Every version of the cache 
+    # is a folder named by the hash of the source file, it is written to a 
+    # temporary folder of this process and moved into place when complete, so
+    # concurrent processes never read or overwrite a partial cache
+    cache_path = get_cache_path(csv_path)
+    os.makedirs(cache_path, exist_ok=True)
+    
+    stat   = os.stat(csv_path)
+    sha256 = get_file_hash(csv_path)
+    version_path = os.path.join(cache_path, sha256)
+    
+    if not os.path.isfile(os.path.join(version_path, "meta.json")):
+        tmp_path = tempfile.mkdtemp(prefix=".tmp_", dir=cache_path)
+        try:
+            df   = pd.read_csv(csv_path, parse_dates=['time'], index_col='time')
+            meta = {"naive"   : df.index.tz == None,
+                    "columns" : [],
+                    }
+            
+            # naive timestamps are stored as given, aware ones in UTC
+            time = df.index if meta["naive"] else df.index.tz_convert("UTC").tz_localize(None)
+            np.save(os.path.join(tmp_path, "time.npy"), time.values.astype("datetime64[ns]").astype(np.int64))
+            
+            for n, col in enumerate(df.columns):
+                if df[col].dtype == bool:
+                    values = df[col].values
+                elif pd.api.types.is_numeric_dtype(df[col]):
+                    values = df[col].values.astype(np.float32)
+                else:
+                    df[col].reset_index(drop=True).to_pickle(os.path.join(tmp_path, f"col_{n:03d}.pkl"))
+                    meta["columns"].append([col, f"col_{n:03d}.pkl"])
+                    continue
+                np.save(os.path.join(tmp_path, f"col_{n:03d}.npy"), values)
+                meta["columns"].append([col, f"col_{n:03d}.npy"])
+            
+            write_json(os.path.join(tmp_path, "meta.json"), meta)
+            os.replace(tmp_path, version_path)
+        except OSError:
+            # another process moved the same version into place first
+            if not os.path.isfile(os.path.join(version_path, "meta.json")):
+                raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    
+    write_json(os.path.join(cache_path, "current.json"),
+               {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256})
+
+    # versions of older source files and files of the former flat layout,
+    # temporary files and folders of other processes start with a dot
+    for entry in os.listdir(cache_path):
+        if entry in [sha256, "current.json"] or entry.startswith("."):
+            continue
+        path = os.path.join(cache_path, entry)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return version_path
+
+def load_dataset(csv_path, utc=True, use_cache=True):
+    # loads Dataset.csv with a UTC index (utc=True, as in DataModelCV) or with 
+    # the timestamps as given in the file (utc=False, as in CreateIndices)
+    if use_cache == False:
+        return read_dataset_csv(csv_path, utc)
+    
+    version_path = get_cache_version(csv_path)
+    if version_path is None:
+        print("building dataset cache")
+        try:
+            version_path = build_dataset_cache(csv_path)
+        except OSError as e:
+            print(f"dataset cache can not be written ({e}), reading the csv")
+            return read_dataset_csv(csv_path, utc)
+    
+    meta = read_json(os.path.join(version_path, "meta.json"))
+    time = pd.DatetimeIndex(np.load(os.path.join(version_path, "time.npy")).astype("datetime64[ns]"), name="time")
+    if meta["naive"] == False:
+        time = time.tz_localize("UTC")
+    elif utc:
+        # make TZ aware, as in read_dataset_csv
+        print("datetimes set to UTC+0000")
+        time = time.tz_localize("Europe/London", ambiguous='raise').tz_convert("UTC")
+    
+    columns = {col: pd.read_pickle(os.path.join(version_path, file)).values if file.endswith(".pkl") else np.load(os.path.join(version_path, file), mmap_mode="r") 
+               for col, file in meta["columns"]}
+    return pd.DataFrame(columns, index=time)
+
+def expand_windows(anchors, first, length):
+    # dense (n_samples, length, 1) index array of windows starting at anchor + first
+    return (anchors[:,None].astype(int) + np.arange(first, first + length, dtype=int)[None,:])[:,:,None]
+
+def window_offsets(hincast_len):
+    # position of the first row of the hincast, forecast and target window relative to the anchor
+    return (1 - hincast_len, 1, 1)
+
+def anchors_from_windows(i_hincast, i_forecast, i_target):
+    # recover anchors from dense index arrays, rows that are no valid windows are dropped
+    anchors = i_hincast[:,-1,0]
+    valid = np.ones(anchors.shape[0], dtype=bool)
+    for idx, first in zip((i_hincast, i_forecast, i_target), window_offsets(i_hincast.shape[1])):
+        valid &= np.all(idx == expand_windows(anchors, first, idx.shape[1]), axis=(1,2))
+    return anchors[valid].astype(np.int32), valid
 
 #############################
 #         Classes
 #############################
 class CreateIndices:
-    def __init__(self, data_path = r"data\Dataset.csv", out_path = "cross_indices"):
+    def __init__(self, data_path = r"data\Dataset.csv", out_path = "cross_indices", use_cache=True):
         self.data_path = data_path
         if os.path.isdir(out_path) == False:
             os.mkdir(out_path)
         self.out_path  = out_path
         # load data
-        self.df = pd.read_csv(data_path, parse_dates=['time'], index_col='time')
-        self.df = self.df.set_index(pd.to_datetime(self.df.index))
+        self.df = load_dataset(data_path, utc=False, use_cache=use_cache)
         self.df["n_idx"] = np.arange(self.df.shape[0], dtype=int)
         try: 
             self.mask = self.df["is_peak_flow"].values.tolist()
         except:
             print("no masking column found")
             self.mask = [True for x in range(self.df.shape[0])]
+        self.gap_index = {}
 
     def prepare_hincast_data(self, observations, hincastlen, forecastlen, start_index):
         X = []
@@ -66,82 +278,213 @@ class CreateIndices:
         
         return X, y
 
+    def get_timeline(self):
+        # int64 [ns] timestamps of all rows, position n equals n_idx
+        return self.df.index.values.astype("datetime64[ns]").astype(np.int64)
+
+    def get_gap_index(self, dtime_secs=15*60):
+        # prefix sum over non-contiguous time steps, computed once per dataset:
+        # rows a..b are contiguous if gap_index[b] == gap_index[a]
+        if dtime_secs not in self.gap_index:
+            is_gap = np.diff(self.get_timeline()) != np.int64(dtime_secs * 10**9)
+            self.gap_index[dtime_secs] = np.concatenate([[0], np.cumsum(is_gap)])
+        return self.gap_index[dtime_secs]
+
+    def get_splits(self, hincast_len, n_sets, dtime_secs=15*60):
+        hindcast_delta = hincast_len * timedelta(seconds=dtime_secs)
+        
+        start_date = self.df.index[0]  + hindcast_delta
+        end_date   = self.df.index[-1]
+        
+        return [(start_date + x * (end_date-start_date) / n_sets).round('1d') for x in range(0,n_sets+1)]
+
     #%%
-    def create(self, n_sets = 7, 
-               hincast_lengths = [12, 24, 36, 48, 60, 72, 84, 96, 108, 120], 
-               forecast_len = 96, 
-               target_len = 96, 
-               oscilation_len=0, 
-               dtime_secs=15*60):
-        for hincast_len in hincast_lengths:
-            print("prepareing index arrays")
-            
-            hindcast_delta  = hincast_len * timedelta(seconds=dtime_secs)
-            forecast_delta  = forecast_len* timedelta(seconds=dtime_secs)
-            target_delta    = target_len  * timedelta(seconds=dtime_secs)
-            
-            start_date = self.df.index[0]  + hindcast_delta
-            end_date   = self.df.index[-1]
+    def build_windows_loop(self, dates, set_limit, hincast_len, forecast_len, target_len, dtime_secs=15*60):
+        # reference implementation: label lookup of every window, one sample at a time
+        hindcast_delta  = hincast_len * timedelta(seconds=dtime_secs)
+        forecast_delta  = forecast_len* timedelta(seconds=dtime_secs)
+        target_delta    = target_len  * timedelta(seconds=dtime_secs)
+        
+        n_samples = len(dates)
+        
+        i_hincast  = np.zeros((n_samples, hincast_len, 1), dtype=int)
+        i_forecast = np.zeros((n_samples, forecast_len, 1), dtype=int)
+        i_target   = np.zeros((n_samples, target_len,   1), dtype=int)
+        
+        valid = np.ones(n_samples, dtype=bool)
+        for n,date in enumerate(dates):
+            hindcast_dates = pd.date_range(date - hindcast_delta, date, freq=f"{dtime_secs:d}s")[1:]
+            forecast_dates = pd.date_range(date, date + forecast_delta, freq=f"{dtime_secs:d}s")[1:]
+            target_dates   = pd.date_range(date, date + target_delta,   freq=f"{dtime_secs:d}s")[1:]
             
+            if forecast_dates[-1] > set_limit:
+                print("set limit reached")
+                valid[n] = False
+                continue
             
-            i_splits = [(start_date + x * (end_date-start_date) / n_sets).round('1d') for x in range(0,n_sets+1)]
+            try:
+                i_hincast[n,:,0]  = self.df.loc[hindcast_dates, "n_idx"].values
+                i_forecast[n,:,0] = self.df.loc[forecast_dates, "n_idx"].values
+                i_target[n,:,0]   = self.df.loc[target_dates,   "n_idx"].values
+            except:
+                print(f"an error occured in sample {n}: sample was removed")
+                valid[n] = False
+        
+        return i_hincast[valid], i_forecast[valid], i_target[valid]
+    
+    def build_anchors(self, dates, set_limit, hincast_len, forecast_len, target_len, dtime_secs=15*60):
+        # vectorized builder: all windows of a set are derived from the
+        # integer position (n_idx) of their anchor date at once, a window is
+        # valid if it does not cross a gap or the set limit
+        timeline = self.get_timeline()
+        gaps     = self.get_gap_index(dtime_secs)
+        
+        t_anchor = pd.DatetimeIndex(dates).values.astype("datetime64[ns]").astype(np.int64)
+        anchors  = timeline.searchsorted(t_anchor)
+        
+        return find_valid_anchors(timeline, gaps, anchors, pd.Timestamp(set_limit).value, 
+                                  hincast_len, forecast_len, target_len, dtime_secs)
+    
+    def build_windows(self, dates, set_limit, hincast_len, forecast_len, target_len, dtime_secs=15*60):
+        anchors = self.build_anchors(dates, set_limit, hincast_len, forecast_len, target_len, dtime_secs)
+        return tuple(expand_windows(anchors, first, length) 
+                     for first, length in zip(window_offsets(hincast_len), (hincast_len, forecast_len, target_len)))
+
+    def check_anchors(self, anchors, hincast_len, forecast_len):
+        # the windows of all anchors have to lie within the dataset
+        if np.max(anchors) + forecast_len >= self.df["n_idx"].values[-1]:
+            print(f"index error: {np.max(anchors) + forecast_len}")
+        if np.min(anchors) - hincast_len + 1 < 0:
+            print("index error: index below 0")
+    
+    def create_sets(self, n_sets, hincast_len, forecast_len, target_len, dtime_secs=15*60, method="vectorized"):
+        # returns the anchor positions of all samples for each set
+        if method not in ["vectorized", "loop"]:
+            raise ValueError(f"unknown method '{method}', use 'vectorized' or 'loop'")
+        
+        forecast_delta  = forecast_len* timedelta(seconds=dtime_secs)
+        
+        i_splits = self.get_splits(hincast_len, n_sets, dtime_secs)
+        
+        df_part = self.df.loc[self.mask]
+        
+        sets = {}
+        for n_set, i in enumerate(range(1,n_sets+1)):
+            print(f"processing set {n_set+1}")
+            set_mask = (df_part.index > i_splits[i-1]) & (df_part.index < i_splits[i] - forecast_delta)
+            args = (df_part.index[set_mask], i_splits[i], hincast_len, forecast_len, target_len, dtime_secs)
             
-            df_part = self.df.loc[self.mask]
+            if method == "vectorized":
+                anchors = self.build_anchors(*args)
+            else:
+                anchors, _ = anchors_from_windows(*self.build_windows_loop(*args))
             
-            sets = {}
+            self.check_anchors(anchors, hincast_len, forecast_len)
+        
+            sets[n_set] = anchors
+        
+        print("set sizes (anchors):")
+        for key in sets.keys():
+            print(f"    set {key}: {sets[key].shape}")
+        
+        return sets
+    
+    def create_sets_parallel(self, n_sets, hincast_lengths, forecast_len, target_len, dtime_secs=15*60, n_workers=None):
+        # builds all (hincast length, set) jobs in a process pool, the workers 
+        # read timeline, gap index and mask from shared memory
+        arrays = {"timeline": self.get_timeline(),
+                  "gaps"    : self.get_gap_index(dtime_secs),
+                  "mask"    : np.asarray(self.mask, dtype=bool),
+                  }
+        
+        jobs = []
+        for hincast_len in hincast_lengths:
+            i_splits = [x.value for x in self.get_splits(hincast_len, n_sets, dtime_secs)]
+            forecast_delta = forecast_len * dtime_secs * 10**9
             for n_set, i in enumerate(range(1,n_sets+1)):
-                print(f"processing set {n_set+1}")
-                set_mask = (df_part.index > i_splits[i-1]) & (df_part.index < i_splits[i] - forecast_delta)
-                df_part_set = df_part.loc[set_mask]
-                
-                n_samples = df_part_set.shape[0]
-                
-                i_hincast  = np.zeros((n_samples, hincast_len, 1), dtype=int)
-                i_forecast = np.zeros((n_samples, forecast_len + oscilation_len, 1), dtype=int)
-                i_target   = np.zeros((n_samples, target_len   + oscilation_len, 1), dtype=int)
-                
-                for n,date in enumerate(df_part_set.index):
-                    hindcast_dates = pd.date_range(date - hindcast_delta, date, freq=f"{dtime_secs:d}s")[1:]
-                    forecast_dates = pd.date_range(date, date + forecast_delta, freq=f"{dtime_secs:d}s")[1:]
-                    target_dates   = pd.date_range(date, date + target_delta,   freq=f"{dtime_secs:d}s")[1:]
-                    
-                    if forecast_dates[-1] > i_splits[i]:
-                        print("set limit reached")
-                        np.delete(i_hincast,  n, axis=0)
-                        np.delete(i_forecast, n, axis=0)
-                        np.delete(i_target,   n, axis=0)
-                        continue
-                    
-                    try:
-                        i_hincast[n,:,0]  = self.df.loc[hindcast_dates, "n_idx"].values
-                        i_forecast[n,:,0] = self.df.loc[forecast_dates, "n_idx"].values
-                        i_target[n,:,0]   = self.df.loc[target_dates,   "n_idx"].values
-                    except:
-                        print(f"an error occured in sample {n}: sample was removed")
-                        np.delete(i_hincast,  n, axis=0)
-                        np.delete(i_forecast, n, axis=0)
-                        np.delete(i_target,   n, axis=0)
-                    
-                
-                if np.max(i_forecast) >= self.df["n_idx"].values[-1]:
-                    print(f"index error: {np.max(i_forecast)}")
-                if np.min(i_hincast) < 0:
-                    print("index error: index below 0")
-            
-                sets[n_set] = (i_hincast, i_forecast, i_target)
-            
-            print("set sizes (hincast, forecast, target):")
-            for key in sets.keys():
-                print(f"    set {key}: ({sets[key][0].shape}, {sets[key][1].shape}, {sets[key][2].shape})")
-            
+                jobs.append((hincast_len, n_set, i_splits[i-1], i_splits[i] - forecast_delta, i_splits[i], 
+                             forecast_len, target_len, dtime_secs))
+        
+        shms  = []
+        specs = {}
+        try:
+            for key, array in arrays.items():
+                shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+                shms.append(shm)
+                specs[key] = (shm.name, array.shape, array.dtype.str)
             
+            all_sets = {hincast_len: {} for hincast_len in hincast_lengths}
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=attach_shared_arrays, initargs=(specs,)) as pool:
+                futures = [pool.submit(build_set_job, *job) for job in jobs]
+                for future in as_completed(futures):
+                    hincast_len, n_set, anchors = future.result()
+                    print(f"processed set {n_set+1} of hincast length {hincast_len}")
+                    all_sets[hincast_len][n_set] = anchors
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+        
+        # same checks as create_sets
+        for hincast_len, sets in all_sets.items():
+            for n_set in sorted(sets.keys()):
+                self.check_anchors(sets[n_set], hincast_len, forecast_len)
+        
+        return {hincast_len: dict(sorted(sets.items())) for hincast_len, sets in all_sets.items()}
+    
+    def save(self, dic, filename):
+        # written to a temporary file first, readers never see a partial file
+        tmp_file = os.path.join(self.out_path, f".{filename}.{os.getpid()}.tmp")
+        with open(tmp_file, 'wb') as fp:
+            pickle.dump(dic, fp)
+        os.replace(tmp_file, os.path.join(self.out_path, filename))
+        print('dictionary saved successfully to file')
+
+    def create(self, n_sets = 7, 
+               hincast_lengths = [12, 24, 36, 48, 60, 72, 84, 96, 108, 120], 
+               forecast_len = 96, 
+               target_len = 96, 
+               oscilation_len=0, 
+               dtime_secs=15*60,
+               method="vectorized",
+               shared=False,
+               n_workers=1):
+        if shared:
+            # one artifact for all hindcast lengths: splits and samples are
+            # computed at the longest hindcast length, shorter hindcast windows
+            # are the trailing part of it and only differ in their hincast offset
+            print(f"prepareing shared index arrays for hincast lengths {sorted(hincast_lengths)}")
+            build_lengths = [max(hincast_lengths)]
+        else:
+            print("prepareing index arrays")
+            build_lengths = hincast_lengths
+        
+        if n_workers is None or n_workers > 1:
+            if method != "vectorized":
+                raise ValueError("parallel index generation requires method 'vectorized'")
+            all_sets = self.create_sets_parallel(n_sets, build_lengths, 
+                                                 forecast_len + oscilation_len, 
+                                                 target_len   + oscilation_len, 
+                                                 dtime_secs, n_workers)
+        else:
+            all_sets = {}
+            for hincast_len in build_lengths:
+                all_sets[hincast_len] = self.create_sets(n_sets, hincast_len, 
+                                                         forecast_len + oscilation_len, 
+                                                         target_len   + oscilation_len, 
+                                                         dtime_secs, method)
+        
+        for hincast_len, sets in all_sets.items():
             dic = {"sets"  : sets,
                    "params": {"n_sets"       : n_sets,
                               "hincast_len"  : hincast_len,
                               "forecast_len" : forecast_len + oscilation_len,
                               "target_len"   : target_len + oscilation_len,
+                              "index_format" : "anchor",
                 }}
-            with open(os.path.join(self.out_path, f'cross_indices_{hincast_len}.pkl'), 'wb') as fp:
-                pickle.dump(dic, fp)
-            print('dictionary saved successfully to file')
-
+            if shared:
+                dic["params"]["hincast_lengths"] = sorted(hincast_lengths)
+                self.save(dic, 'cross_indices_shared.pkl')
+            else:
+                self.save(dic, f'cross_indices_{hincast_len}.pkl')
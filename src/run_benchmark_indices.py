@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Manuel Pirker
+"""
+
+#############################
+#         Imports
+#############################
+from ForecastModel.utils.preprocessing import CreateIndices
+
+import pandas as pd
+import numpy as np
+
+from time import perf_counter
+import tempfile
+import os
+
+#############################
+#         Init
+#############################
+N_YEARS      = 10
+N_GAPS       = 20       # number of missing blocks in the synthetic record
+LOOP_SAMPLES = 20000    # the sample loop is timed on a subset and extrapolated
+HINCAST_LEN  = 96
+FORECAST_LEN = 96
+TARGET_LEN   = 96
+DTIME_SECS   = 15*60
+SEED         = 17
+
+#############################
+#         Functions
+#############################
+def create_synthetic_dataset(path, n_years=N_YEARS, n_gaps=N_GAPS, seed=SEED):
+    # 15 minute record with a seasonal signal, noise and some missing blocks
+    rng   = np.random.default_rng(seed)
+    time  = pd.date_range("2000-01-01", periods=int(n_years*365.25*24*4), freq=f"{DTIME_SECS:d}s")
+    phase = 2*np.pi * np.arange(len(time)) / (365.25*24*4)
+
+    df = pd.DataFrame({"qsim"    : 10 + 5*np.sin(phase) + rng.normal(0, 1, len(time)),
+                       "pmax"    : rng.exponential(1, len(time)),
+                       "qmeasval": 10 + 5*np.sin(phase) + rng.normal(0, 1, len(time)),
+                       }, index=pd.Index(time, name="time"))
+
+    keep = np.ones(len(time), dtype=bool)
+    for start in rng.integers(0, len(time), n_gaps):
+        keep[start:start + rng.integers(1, 200)] = False
+
+    df.loc[keep].to_csv(path)
+
+def time_call(fcn, *args):
+    t0 = perf_counter()
+    rst = fcn(*args)
+    return rst, perf_counter() - t0
+
+#############################
+#         Main
+#############################
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = os.path.join(tmp_dir, "Dataset.csv")
+        create_synthetic_dataset(data_path)
+
+        ci = CreateIndices(data_path, out_path=os.path.join(tmp_dir, "indices"))
+        print(f"synthetic record: {ci.df.shape[0]} rows ({N_YEARS} years)")
+
+        i_splits = ci.get_splits(HINCAST_LEN, 1, DTIME_SECS)
+        dates    = ci.df.index[(ci.df.index > i_splits[0]) & (ci.df.index < i_splits[1] - FORECAST_LEN*pd.Timedelta(seconds=DTIME_SECS))]
+        args     = (i_splits[1], HINCAST_LEN, FORECAST_LEN, TARGET_LEN, DTIME_SECS)
+
+        rst_vec, t_vec = time_call(ci.build_windows, dates, *args)
+
+        n_loop = min(LOOP_SAMPLES, len(dates))
+        rst_loop, t_loop = time_call(ci.build_windows_loop, dates[:n_loop], *args)
+        t_loop_total = t_loop * len(dates) / n_loop
+
+        rst_vec_subset = ci.build_windows(dates[:n_loop], *args)
+        for name, a, b in zip(["hincast", "forecast", "target"], rst_vec_subset, rst_loop):
+            assert np.array_equal(a, b), f"{name} indices differ between loop and vectorized builder"
+
+        print(f"samples:    {len(dates)}")
+        print(f"vectorized: {t_vec:8.3f} s")
+        print(f"loop:       {t_loop_total:8.3f} s (extrapolated from {n_loop} samples)")
+        print(f"speedup:    {t_loop_total/t_vec:8.1f} x")
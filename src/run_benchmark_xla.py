@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Manuel Pirker
+"""
+
+#############################
+#         Imports
+#############################
+import os
+# benchmark on CPU
+os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+import tensorflow as tf
+import numpy as np
+
+from time import perf_counter
+
+from ForecastModel.models import Hindcast, CompiledPredictor
+
+#############################
+#         Init
+#############################
+N_SAMPLES     = 20000
+EPOCHS        = 3       # the first epoch includes tracing and compilation and is not timed
+LATENCY_RUNS  = 50
+SEED          = 17
+
+hyperparameter = {
+       "dropout_rate"   : 0.1,
+       "lstm_unit"      : 16,
+       "lr"             : 0.005,
+       "batch_size"     : 4000,
+       "hindcast_len"   : 48,
+       "forecast_len"   : 96,
+       "target_len"     : 96,
+       "n_features_hc"  : 3,
+       "n_features_fc"  : 2,
+       }
+
+#############################
+#         Functions
+#############################
+def build(jit_compile):
+    model = Hindcast.build_model(hyperparameter)
+    model.compile(optimizer   = tf.keras.optimizers.Adam(learning_rate=hyperparameter["lr"], clipvalue=0.5, clipnorm=0.001),
+                  loss        = 'mean_squared_error',
+                  jit_compile = jit_compile,
+                  )
+    return model
+
+def train_samples_per_sec(model, x, y):
+    batch_size = hyperparameter["batch_size"]
+    model.fit(x, y, epochs=1, batch_size=batch_size, verbose=0)
+
+    t0 = perf_counter()
+    model.fit(x, y, epochs=EPOCHS-1, batch_size=batch_size, verbose=0)
+    return (EPOCHS-1) * y.shape[0] / (perf_counter() - t0)
+
+def latency_ms(predict_fcn, x):
+    predict_fcn(x)
+
+    t0 = perf_counter()
+    for _ in range(LATENCY_RUNS):
+        predict_fcn(x)
+    return (perf_counter() - t0) / LATENCY_RUNS * 1000
+
+#############################
+#         Main
+#############################
+if __name__ == "__main__":
+    rng = np.random.default_rng(SEED)
+    x = [rng.random((N_SAMPLES, hyperparameter["hindcast_len"], hyperparameter["n_features_hc"]), dtype=np.float32),
+         rng.random((N_SAMPLES, hyperparameter["forecast_len"], hyperparameter["n_features_fc"]), dtype=np.float32)]
+    y = rng.random((N_SAMPLES, hyperparameter["target_len"]), dtype=np.float32)
+
+    for jit_compile in [False, True]:
+        tf.keras.backend.clear_session()
+        tf.keras.utils.set_random_seed(SEED)
+        model = build(jit_compile)
+
+        samples_per_sec = train_samples_per_sec(model, x, y)
+
+        if jit_compile:
+            predictor = CompiledPredictor(model, hyperparameter["batch_size"])
+            predict_single = CompiledPredictor(model, 1).predict
+            predict_batch  = predictor.predict
+        else:
+            predict_single = lambda x: model.predict(x, batch_size=1, verbose=0)
+            predict_batch  = lambda x: model.predict(x, batch_size=hyperparameter["batch_size"], verbose=0)
+
+        t_single = latency_ms(predict_single, [xi[:1] for xi in x])
+        t_batch  = latency_ms(predict_batch,  [xi[:hyperparameter["batch_size"]] for xi in x])
+
+        print(f"jit_compile={str(jit_compile):5s}: train {samples_per_sec:9.1f} samples/s, "
+              f"predict 1 sample {t_single:7.2f} ms, {hyperparameter['batch_size']} samples {t_batch:8.2f} ms")
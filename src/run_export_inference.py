@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Manuel Pirker
+"""
+
+#############################
+#         Imports
+#############################
+import tensorflow as tf
+import numpy as np
+
+from time import perf_counter
+import glob
+import os
+
+from ForecastModel.inference import export_hindcast, HindcastEngine
+
+#############################
+#         Init
+#############################
+# trained models of a trial, every .keras file is exported next to it as .npz
+MODEL_PATH = r"trials\tb\20240101HLSTM_test\hp\trial_00"
+N_SAMPLES  = 4000
+RTOL       = 1e-4
+ATOL       = 1e-4
+SEED       = 17
+
+#############################
+#         Main
+#############################
+if __name__ == "__main__":
+    rng = np.random.default_rng(SEED)
+    
+    for model_file in sorted(glob.glob(os.path.join(MODEL_PATH, "*.keras"))):
+        model = tf.keras.models.load_model(model_file)
+        
+        npz_file = os.path.splitext(model_file)[0] + ".npz"
+        export_hindcast(model, npz_file)
+        engine = HindcastEngine.from_npz(npz_file)
+        
+        # scaled inputs are within [0, 1]
+        x = [rng.random((N_SAMPLES,) + tuple(inp.shape[1:]), dtype=np.float32) for inp in model.inputs]
+        
+        t0 = perf_counter()
+        y_keras = model.predict(x, batch_size=N_SAMPLES, verbose=0)
+        t_keras = perf_counter() - t0
+        
+        t0 = perf_counter()
+        y_numpy = engine.predict(x)
+        t_numpy = perf_counter() - t0
+        
+        max_diff = np.max(np.abs(y_keras - y_numpy))
+        assert np.allclose(y_keras, y_numpy, rtol=RTOL, atol=ATOL), f"{model_file}: numpy engine differs by {max_diff}"
+        
+        print(f"{os.path.basename(npz_file)}: {os.path.getsize(npz_file)/1024:6.1f} kB, max abs diff {max_diff:.2e}, "
+              f"keras {t_keras*1000:7.1f} ms, numpy {t_numpy*1000:7.1f} ms")
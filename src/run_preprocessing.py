@@ -17,6 +17,11 @@ import numpy as np
 #############################
 OUT_DATA_PATH    = r"data\Dataset.csv"
 OUT_INDICES_PATH = r"data\indices" 
+# write one shared file for all hincast lengths instead of one file per length,
+# run_tuner.py only uses it with shared_indices = True
+SHARED_INDICES   = False
+# number of worker processes for the (hincast length, set) jobs, None uses all cores
+N_WORKERS        = 1
 
 #############################
 #         Main
@@ -28,4 +33,6 @@ if __name__ == "__main__":
             hincast_lengths = [48,96], 
             forecast_len = 96, 
             target_len = 96,
+            shared = SHARED_INDICES,
+            n_workers = N_WORKERS,
             )
\ No newline at end of file
@@ -33,6 +33,15 @@ patience        = 10
 max_trials      = 50
 inital_trials   = 30
 overwrite       = True
+streaming       = False  # gather training batches on the fly instead of materializing every fold
+seed            = None   # sample order of the shuffled training batches, the same with and without streaming
+n_fold_workers  = 1      # train the cross validation folds in parallel CPU processes
+prune_percentile = None  # e.g. 50 stops trials whose running objective is worse than the median of completed trials
+walk_forward    = False  # start each fold from the previous fold's weights and fine-tune on the new set
+warm_epochs     = 5
+warm_lr_factor  = 0.5
+jit_compile     = False  # XLA compiled fit and fixed shape predict, see run_benchmark_xla.py
+shared_indices  = False  # use cross_indices_shared.pkl of run_preprocessing.py, its splits are set at the longest hincast length
 
 model_name = "HLSTM_test"
 
@@ -90,45 +99,11 @@ def call_model(hp):
                                          clipnorm=0.001)
     model.compile(optimizer=optimizer, 
                loss='mean_squared_error',
+               jit_compile=jit_compile,
                )
     
     return model
 
-#############################
-#         Main
-#############################
-# create paths
-if os.path.isdir(TB_LOG_PATH) == False:
-    os.mkdir(TB_LOG_PATH)
-    os.mkdir(os.path.join(TB_LOG_PATH, "logs"))
-    os.mkdir(os.path.join(TB_LOG_PATH, "hp"))
-    
-# save feature list
-print(os.path.join(TB_LOG_PATH, "features.txt"))
-with open(os.path.join(TB_LOG_PATH, "features.txt"), "w") as f:
-    json.dump(features, f)
-
-# init datamodel 
-dm = DataModelCV(DATA_PATH,
-               target_name       = features["target_name"],
-               hincast_features  = features["feat_hindcast"],
-               forecast_features = features["feat_forecast"],
-               )
-
-# init hyperparameter object
-hp = keras_tuner.HyperParameters()
-
-# init tuner
-tuner = MyTuner(
-    hypermodel         = call_model,
-    objective          = "val_loss",
-    max_trials         = max_trials,
-    num_initial_points = inital_trials,
-    overwrite          = overwrite,
-    directory          = TB_LOG_PATH,
-    project_name       = "hp",
-    )
-
 # define lr scheudler
 def scheduler(epoch, lr):
     if epoch == 0:
@@ -140,20 +115,69 @@ def scheduler(epoch, lr):
     else:
         return lr
 
-# start tuner
-tuner.search(
-          data_model = dm,
-          epochs  = num_epochs, 
-          shuffle = True,
-          verbose = 1,
-          callbacks=[tf.keras.callbacks.LearningRateScheduler(scheduler),
-                     tf.keras.callbacks.EarlyStopping("val_loss", 
-                                                        patience=patience, # min_delta=0.001, 
-                                                        restore_best_weights=True),
-                                             ],
-          cross_indices_path   = CROSS_INDICES_PATH, 
-          tb_log_path          = TB_LOG_PATH,
-          plot_fold_rst        = True, 
-          save_fold_models     = True, 
-          save_fold_prediction = False,
-          )
\ No newline at end of file
+#############################
+#         Main
+#############################
+# worker processes for the folds import this module, so only run the search as script
+if __name__ == "__main__":
+    # started by run_tuner_distributed.py all tuners share TB_LOG_PATH, 
+    # only the chief sets up the project and writes the feature list
+    tuner_id = os.environ.get("KERASTUNER_TUNER_ID")
+    is_chief = tuner_id in [None, "chief"]
+    
+    # create paths
+    os.makedirs(os.path.join(TB_LOG_PATH, "logs"), exist_ok=True)
+    os.makedirs(os.path.join(TB_LOG_PATH, "hp"),   exist_ok=True)
+    
+    # save feature list
+    if is_chief:
+        print(os.path.join(TB_LOG_PATH, "features.txt"))
+        with open(os.path.join(TB_LOG_PATH, "features.txt"), "w") as f:
+            json.dump(features, f)
+
+    # init datamodel 
+    dm = DataModelCV(DATA_PATH,
+                   target_name       = features["target_name"],
+                   hincast_features  = features["feat_hindcast"],
+                   forecast_features = features["feat_forecast"],
+                   )
+
+    # init hyperparameter object
+    hp = keras_tuner.HyperParameters()
+
+    # init tuner
+    tuner = MyTuner(
+        hypermodel         = call_model,
+        objective          = "val_loss",
+        max_trials         = max_trials,
+        num_initial_points = inital_trials,
+        overwrite          = overwrite and is_chief,
+        directory          = TB_LOG_PATH,
+        project_name       = "hp",
+        )
+
+    # start tuner
+    tuner.search(
+              data_model = dm,
+              epochs  = num_epochs, 
+              shuffle = True,
+              verbose = 1,
+              callbacks=[tf.keras.callbacks.LearningRateScheduler(scheduler),
+                         tf.keras.callbacks.EarlyStopping("val_loss", 
+                                                            patience=patience, # min_delta=0.001, 
+                                                            restore_best_weights=True),
+                                                 ],
+              cross_indices_path   = CROSS_INDICES_PATH, 
+              tb_log_path          = TB_LOG_PATH,
+              plot_fold_rst        = True, 
+              save_fold_models     = True, 
+              save_fold_prediction = False,
+              streaming            = streaming,
+              seed                 = seed,
+              n_fold_workers       = n_fold_workers,
+              prune_percentile     = prune_percentile,
+              walk_forward         = walk_forward,
+              warm_epochs          = warm_epochs,
+              warm_lr_factor       = warm_lr_factor,
+              shared_indices       = shared_indices,
+              )
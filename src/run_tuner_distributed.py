@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Manuel Pirker
+"""
+
+#############################
+#         Imports
+#############################
+import os
+import sys
+import socket
+import subprocess
+import time
+
+#############################
+#         Init
+#############################
+# local distributed search: one chief holding the oracle plus worker tuners,
+# every worker runs its own trials of run_tuner.py
+N_WORKERS          = 4
+ORACLE_IP          = "127.0.0.1"
+ORACLE_PORT        = 8000
+THREADS_PER_WORKER = max(1, os.cpu_count() // N_WORKERS)
+CHIEF_TIMEOUT      = 120  # seconds until the chief has to serve the oracle
+
+TUNER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_tuner.py")
+
+#############################
+#         Functions
+#############################
+def start_tuner(tuner_id, threads):
+    env = dict(os.environ,
+               KERASTUNER_TUNER_ID    = tuner_id,
+               KERASTUNER_ORACLE_IP   = ORACLE_IP,
+               KERASTUNER_ORACLE_PORT = str(ORACLE_PORT),
+               # CPU thread budget of the tuner process
+               TF_NUM_INTRAOP_THREADS = str(threads),
+               TF_NUM_INTEROP_THREADS = "1",
+               OMP_NUM_THREADS        = str(threads),
+               )
+    return subprocess.Popen([sys.executable, TUNER_SCRIPT], env=env)
+
+def wait_for_oracle(chief, timeout=CHIEF_TIMEOUT):
+    # polls the oracle port until the chief accepts connections
+    t_end = time.time() + timeout
+    while chief.poll() is None:
+        try:
+            with socket.create_connection((ORACLE_IP, ORACLE_PORT), timeout=1):
+                return
+        except OSError:
+            if time.time() > t_end:
+                chief.terminate()
+                raise TimeoutError(f"chief is not serving the oracle on {ORACLE_IP}:{ORACLE_PORT} after {timeout} s")
+            time.sleep(0.5)
+    raise RuntimeError(f"chief exited with code {chief.returncode} before serving the oracle")
+
+#############################
+#         Main
+#############################
+if __name__ == "__main__":
+    # the chief only serves the oracle
+    chief = start_tuner("chief", 1)
+    wait_for_oracle(chief)
+
+    workers = [start_tuner(f"tuner{n}", THREADS_PER_WORKER) for n in range(N_WORKERS)]
+
+    try:
+        exit_codes = [p.wait() for p in workers]
+        chief.wait()
+    except KeyboardInterrupt:
+        for p in workers + [chief]:
+            p.terminate()
+        raise
+
+    print(f"workers finished with exit codes {exit_codes}")